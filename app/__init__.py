@@ -1,13 +1,151 @@
-# import os
-# from flask import Flask
-# from .routes import main_bp
+import time
+from flask import Flask, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
 
+from . import metrics, profiling
+from .config import Config, db
 
-# def create_app():
-#     app = Flask(__name__, static_folder='static') 
-#     app.secret_key = os.environ.get('CAR_VALUATION_FLASK_KEY')
 
-#     # Register the Blueprint
-#     app.register_blueprint(main_bp)
+def in_memory_sqlite(uri: str) -> bool:
+    """
+    Returns True if uri is an in-memory SQLite database, e.g. sqlite:// in tests.
+    """
+    url = make_url(uri)
+    return (url.get_backend_name() == 'sqlite'
+            and (url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory'))
 
-#     return app
\ No newline at end of file
+
+def engine_options(config) -> dict:
+    """
+    Returns the SQLAlchemy engine options for the pool settings in config.
+    """
+    if in_memory_sqlite(config['SQLALCHEMY_DATABASE_URI']):
+        # Flask-SQLAlchemy keeps an in-memory database on one shared connection
+        # (StaticPool), which takes none of the pool settings
+        return {'connect_args': {'check_same_thread': False}}
+
+    options = {'pool_size': config['DB_POOL_SIZE'],
+               'max_overflow': config['DB_MAX_OVERFLOW'],
+               'pool_timeout': config['DB_POOL_TIMEOUT'],
+               'pool_recycle': config['DB_POOL_RECYCLE'],
+               'pool_pre_ping': True}
+
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # Pooled connections are shared between the threads of a worker
+        options['connect_args'] = {'check_same_thread': False,
+                                   'timeout': config['SQLITE_BUSY_TIMEOUT']}
+
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Switches new SQLite connections to write-ahead logging.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # WAL stays consistent with NORMAL and it avoids a sync on every commit
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def time_requests(app: Flask):
+    """
+    Records the latency and status of every request, and logs the stage
+    breakdown of requests slower than SLOW_REQUEST_SECONDS.
+    """
+    @app.before_request
+    def start_timing():
+        metrics.start_request()
+
+    @app.after_request
+    def finish_timing(response):
+        seconds, stages = metrics.finish_request()
+        endpoint = request.endpoint or 'unmatched'
+        metrics.request_seconds.observe(seconds, endpoint=endpoint)
+        metrics.requests_total.inc(endpoint=endpoint, status=response.status_code)
+
+        slow = app.config['SLOW_REQUEST_SECONDS']
+        if slow is not None and seconds >= slow:
+            breakdown = ', '.join(f"{stage} {stage_seconds * 1e3:.1f} ms" for stage, stage_seconds in stages)
+            print(f"Slow request {request.method} {request.full_path.rstrip('?')} took {seconds * 1e3:.1f} ms: {breakdown or 'no stages'}")
+
+        return response
+
+
+def profile_requests(app: Flask):
+    """
+    Samples the stacks of a fraction of the requests, and of requests whose
+    X-Profile header carries profiling.profile_token (any value in debug mode),
+    and writes them to profiling.profile_dir.
+    """
+    @app.before_request
+    def start_profiling():
+        if profiling.should_profile(request.headers, debug=app.debug):
+            g.stack_sampler = profiling.StackSampler().start()
+
+    @app.teardown_request
+    def finish_profiling(error=None):
+        sampler = g.pop('stack_sampler', None)
+        if sampler is not None:
+            path = profiling.write_folded(request.endpoint or 'unmatched', sampler.stop())
+            if path is not None:
+                print(f"Profile of {request.method} {request.full_path.rstrip('?')} written to {path}")
+
+
+def migrate_schema(app: Flask, attempts: int = 3):
+    """
+    Brings the database schema up to date, see models.ensure_schema.
+
+    gunicorn workers start at the same time and may race to create the same
+    table. The loser's statement fails and it checks the schema again.
+    """
+    from .models import ensure_schema
+
+    with app.app_context():
+        for attempt in range(attempts):
+            try:
+                ensure_schema()
+                return
+            except OperationalError:
+                db.session.rollback()
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.5)
+
+
+def create_app(config=None) -> Flask:
+    """
+    Creates the Flask app with one SQLAlchemy engine and registers the routes.
+
+    config is an optional dict that overrides the values in Config.
+    """
+    app = Flask(__name__, static_folder='static')
+    app.config.from_object(Config)
+    app.config.update(config or {})
+    app.secret_key = app.config['SECRET_KEY']
+
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    db.init_app(app)
+
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') and app.config['SQLITE_WAL']:
+        with app.app_context():
+            event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
+    # Tables and columns added since the database was created (facets, versions,
+    # delisted_at) are created before the first request
+    if app.config['ENSURE_SCHEMA']:
+        migrate_schema(app)
+
+    time_requests(app)
+    # Without a profile directory no hooks are registered, so requests pay nothing
+    if profiling.profile_dir:
+        profile_requests(app)
+
+    # Register the Blueprint
+    from .routes import main_bp
+    app.register_blueprint(main_bp)
+
+    return app
@@ -0,0 +1,191 @@
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .extraction import default_processes, extract_car
+
+
+# Directory of the raw page archive written by the scraper, 'off' turns archiving off
+archive_dir = os.environ.get('CAR_VALUATION_HTML_ARCHIVE',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'html_archive'))
+
+
+class HtmlArchive:
+    """
+    Append-only archive of fetched pages in a local directory.
+
+    Every page is stored once, gzipped, under the sha256 of its html in
+    objects/<first two hex digits>/<sha256>.html.gz. index.jsonl gets one line
+    per fetch with the url, the sha256, the segment and the time, so a page that
+    changed between two scrapes is kept in both versions. Objects are written to
+    a temporary file and renamed, and the index only grows, so several scrapers
+    can write to the same archive.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.jsonl')
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'objects', digest[:2], f"{digest}.html.gz")
+
+    def put(self, url: str, html: str, manufacturer: str, model: str) -> str:
+        """
+        Stores html as fetched from url and returns its sha256.
+        """
+        data = html.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(gzip.compress(data, compresslevel=6))
+            os.replace(tmp_path, path)
+
+        entry = {'url': url, 'sha256': digest, 'manufacturer': manufacturer, 'model': model,
+                 'fetched_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        # One write per line in append mode, so lines of concurrent writers do not interleave
+        with self.lock, open(self.index_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+        return digest
+
+    def get(self, digest: str) -> str:
+        """
+        Returns the html stored under digest.
+        """
+        with open(self.object_path(digest), 'rb') as file:
+            return gzip.decompress(file.read()).decode('utf-8')
+
+    def entries(self) -> list:
+        """
+        Returns the index entries in the order the pages were fetched.
+
+        A line that is still being written by a scraper is skipped, and so is a
+        line that cannot be decoded, e.g. one cut off by a crash, with a message.
+        """
+        if not os.path.exists(self.index_path):
+            return []
+
+        entries = []
+        with open(self.index_path, encoding='utf-8', errors='replace') as file:
+            for number, line in enumerate(file, 1):
+                if not line.endswith('\n'):
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError as error:
+                    print(f"Skipping line {number} of {self.index_path}, due to {error}")
+                    continue
+                if not isinstance(entry, dict) or not {'url', 'sha256', 'manufacturer', 'model'} <= entry.keys():
+                    print(f"Skipping line {number} of {self.index_path}, it is not an index entry")
+                    continue
+                entries.append(entry)
+        return entries
+
+    def latest(self) -> list:
+        """
+        Returns the index entry of the last fetch of every url.
+        """
+        return list({entry['url']: entry for entry in self.entries()}.values())
+
+
+def open_archive(path: str = None):
+    """
+    Returns the HtmlArchive at path (default archive_dir), or None if archiving is off.
+    """
+    path = path or archive_dir
+    return None if path == 'off' else HtmlArchive(path)
+
+
+def _reparse_chunk(path: str, entries: list) -> list:
+    archive = HtmlArchive(path)
+    results = []
+    for entry in entries:
+        try:
+            car = extract_car(entry['url'], archive.get(entry['sha256']))
+            car['manufacturer'] = entry['manufacturer']
+            car['model'] = entry['model']
+            results.append((car, None))
+        except (AttributeError, ValueError, OSError) as error:
+            results.append((None, f"{type(error).__name__}: {error}"))
+    return results
+
+
+def reparse_archive(archive: HtmlArchive, processes: int = None, chunk_size: int = 200) -> tuple:
+    """
+    Extracts the cars from the latest archived page of every url, without any
+    network access, in up to processes worker processes (default one per core).
+
+    The workers read the pages from the archive themselves, so only the index
+    entries are sent to them. Returns the list of car dicts and a list of
+    (url, error message) for the pages that could not be parsed.
+    """
+    entries = archive.latest()
+    chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+    processes = processes or default_processes
+
+    if processes == 1 or len(chunks) <= 1:
+        results = [_reparse_chunk(archive.path, chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes, len(chunks)),
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(_reparse_chunk, [archive.path] * len(chunks), chunks))
+
+    cars, errors = [], []
+    for chunk, chunk_results in zip(chunks, results):
+        for entry, (car, error) in zip(chunk, chunk_results):
+            if car is not None:
+                cars.append(car)
+            else:
+                errors.append((entry['url'], error))
+
+    return cars, errors
+
+
+if __name__ == "__main__":
+    import argparse
+    import csv
+
+    # python -m app.archive [--save] [--tsv backup.tsv] re-extracts all archived
+    # pages, e.g. after a parser fix, and stores the cars that are missing.
+    parser = argparse.ArgumentParser(description="Re-parses the raw page archive without fetching anything.")
+    parser.add_argument('--archive', default=archive_dir)
+    parser.add_argument('--processes', type=int, default=default_processes)
+    parser.add_argument('--save', action='store_true', help="insert cars that are not stored yet in the local database")
+    parser.add_argument('--tsv', help="write all cars to a tab separated backup file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cars, errors = reparse_archive(HtmlArchive(args.archive), processes=args.processes)
+    print(f"Parsed {len(cars)} pages in {time.perf_counter() - start:.1f} s, {len(errors)} failed.")
+    for url, error in errors:
+        print(f"  {url}: {error}")
+
+    if args.tsv:
+        from .models import car_fields
+        with open(args.tsv, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=car_fields, delimiter='\t', extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(cars)
+
+    if args.save:
+        from . import create_app
+        from .models import ensure_schema, refresh_facets, save_cars
+
+        with create_app().app_context():
+            ensure_schema()
+            inserted = save_cars(cars)
+            if inserted:
+                refresh_facets()
+        print(f"Inserted {inserted} cars that were not stored yet.")
@@ -0,0 +1,180 @@
+import csv
+import io
+import json
+import math
+from itertools import islice
+
+from .features import FeatureEncoder
+from .model_registry import predict_with_artifact
+from .training import ModelWarming, request_artifacts
+
+
+# Fields every car in a batch must have. An optional 'id' is echoed back in the result.
+required_fields = ['manufacturer', 'model', 'mileage', 'hp', 'traffic_date', 'fuel', 'gearbox', 'owners']
+int_fields = ['mileage', 'hp', 'owners']
+
+# Number of cars that are read, grouped and scored at a time
+chunk_size = 1000
+
+# Seconds a batch waits for a cold segment to be trained before its cars are reported as warming
+batch_training_wait = 60.0
+
+
+def cars_from_json(data) -> list:
+    """
+    Returns the cars in parsed JSON data, which is either a list of car objects
+    or an object with the list under 'cars'.
+    """
+    if isinstance(data, dict):
+        data = data.get('cars', [])
+
+    if not isinstance(data, list):
+        raise ValueError("Expected a list of cars.")
+
+    return data
+
+
+def iter_cars_from_csv(stream, encoding='utf-8'):
+    """
+    Yields the cars in a CSV (or tab separated) byte stream with a header row, one car per line.
+
+    The stream is read line by line, so the upload is never held in memory.
+    """
+    text = io.TextIOWrapper(stream, encoding=encoding, newline='')
+    first_line = text.readline()
+    delimiter = '\t' if '\t' in first_line else ','
+    header = next(csv.reader([first_line], delimiter=delimiter))
+
+    for row in csv.reader(text, delimiter=delimiter):
+        if row:
+            yield dict(zip(header, row))
+
+
+def iter_cars_from_ndjson(stream, encoding='utf-8'):
+    """
+    Yields the cars in a newline delimited JSON byte stream, one car object per line.
+
+    The stream is read line by line like iter_cars_from_csv. A line that is not
+    valid JSON is yielded as is, so that it is reported as a failed row.
+    """
+    for line in io.TextIOWrapper(stream, encoding=encoding):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield line.strip()
+
+
+def parse_car(car: dict) -> dict:
+    """
+    Validates a car from a batch and converts its numerical fields.
+    Raises ValueError if a field is missing or malformed.
+    """
+    if not isinstance(car, dict):
+        raise ValueError("Expected a car object.")
+
+    missing = [field for field in required_fields if car.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+
+    parsed = {field: str(car[field]).strip() for field in required_fields}
+    for field in int_fields:
+        # inf, nan and numbers too large for a float (e.g. 1e400) are rejected like text
+        try:
+            value = float(car[field])
+        except OverflowError:
+            value = float('inf')
+        if not math.isfinite(value):
+            raise ValueError(f"Malformed {field}: {car[field]}")
+        parsed[field] = int(value)
+
+    # A date the encoder cannot read would fail the whole group in predict_group
+    try:
+        car_age = FeatureEncoder.car_age([parsed['traffic_date']])[0]
+    except ValueError:
+        car_age = float('nan')
+    if car_age != car_age:
+        raise ValueError(f"Malformed traffic_date: {parsed['traffic_date']}")
+
+    # fuel and gearbox are stored in lower case, see get_car_info
+    parsed['fuel'] = parsed['fuel'].lower()
+    parsed['gearbox'] = parsed['gearbox'].lower()
+
+    return parsed
+
+
+def car_columns(rows: list) -> dict:
+    """
+    Returns the cars in rows (list of (index, id, car)) as the dict of lists
+    that predict_with_artifact takes.
+    """
+    return {field: [car[field] for _, _, car in rows]
+            for field in ['mileage', 'hp', 'traffic_date', 'fuel', 'gearbox', 'owners']}
+
+
+def predict_group(manufacturer: str, model: str, rows: list, artifact) -> list:
+    """
+    Predicts the price of all rows (list of (index, id, car)) belonging to the same
+    manufacturer and model with one transform and one predict call. artifact is
+    the result of request_artifacts for the segment. Returns one result dict per row.
+    """
+    if isinstance(artifact, ModelWarming):
+        return [{'row': index, 'id': car_id, 'status': 'warming', 'retry_after': artifact.retry_after}
+                for index, car_id, car in rows]
+    if isinstance(artifact, Exception):
+        return [{'row': index, 'id': car_id, 'status': 'failed', 'message': f"No model for {manufacturer} {model}: {artifact}"}
+                for index, car_id, car in rows]
+
+    try:
+        predicted_prices = predict_with_artifact(artifact, car_columns(rows))
+    except Exception as e:
+        if len(rows) == 1:
+            index, car_id, car = rows[0]
+            return [{'row': index, 'id': car_id, 'status': 'failed', 'message': str(e)}]
+        # Score the cars one at a time, so a car that cannot be scored only fails itself
+        return [result for row in rows for result in predict_group(manufacturer, model, [row], artifact)]
+
+    return [{'row': index,
+             'id': car_id,
+             'status': 'ok',
+             'manufacturer': manufacturer,
+             'model': model,
+             'predicted_price': round(float(price), -3),
+             'error': round(float(price) * artifact['MAPE'], -2),
+             'n_cars': artifact['n_cars'],
+             'model_type': artifact['model_type']}
+            for (index, car_id, car), price in zip(rows, predicted_prices)]
+
+
+def predict_batch(cars, db, table, size=chunk_size, wait=batch_training_wait):
+    """
+    Yields one result dict per car in the iterable cars.
+
+    Cars are consumed in chunks of size. Within a chunk they are grouped by
+    (manufacturer, model) and every group is scored at once, so memory stays
+    bounded by the chunk size no matter how large the batch is. The models of
+    all groups of a chunk are requested together, so cold segments train in
+    parallel and a chunk waits at most wait seconds for them. Results carry the
+    position of the car in the batch ('row') since groups finish out of order.
+    """
+    cars = enumerate(cars)
+
+    while True:
+        chunk = list(islice(cars, size))
+        if not chunk:
+            break
+
+        groups = {}
+        for index, car in chunk:
+            car_id = car.get('id') if isinstance(car, dict) else None
+            try:
+                parsed = parse_car(car)
+            except (ValueError, TypeError, OverflowError) as e:
+                yield {'row': index, 'id': car_id, 'status': 'failed', 'message': str(e)}
+                continue
+
+            groups.setdefault((parsed['manufacturer'], parsed['model']), []).append((index, car_id, parsed))
+
+        artifacts = request_artifacts(list(groups), db, table, wait=wait)
+        for (manufacturer, model), rows in groups.items():
+            yield from predict_group(manufacturer, model, rows, artifacts[(manufacturer, model)])
@@ -1,15 +1,42 @@
 import os
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy 
+from flask_sqlalchemy import SQLAlchemy
 
-app = Flask(__name__, static_folder='static') 
-app.secret_key = os.environ.get('CAR_VALUATION_FLASK_KEY')
 
-# Here we specify location of local SQL database
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///cars.db"
-# We're not gonna track changes to our database for dev purposes
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config['EXPLAIN_TEMPLATE_LOADING'] = True
+class Config:
+    """
+    Default configuration of the app. Every value can be overridden by passing
+    a dict to create_app.
+    """
+    SECRET_KEY = os.environ.get('CAR_VALUATION_FLASK_KEY')
 
-# Create instance of DB
-db = SQLAlchemy(app)
+    # Here we specify location of local SQL database
+    SQLALCHEMY_DATABASE_URI = os.environ.get('CAR_VALUATION_DATABASE_URI', 'sqlite:///cars.db')
+    # We're not gonna track changes to our database for dev purposes
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    EXPLAIN_TEMPLATE_LOADING = True
+
+    # Connection pool of the single engine per worker process. With gunicorn
+    # threads, pool size + overflow should be at least the number of threads.
+    DB_POOL_SIZE = int(os.environ.get('CAR_VALUATION_DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('CAR_VALUATION_DB_MAX_OVERFLOW', 5))
+    # Seconds a request waits for a free connection before it fails
+    DB_POOL_TIMEOUT = 10
+    # Connections older than this many seconds are replaced on checkout
+    DB_POOL_RECYCLE = 3600
+
+    # SQLite only: write-ahead logging lets readers run while the scraper or an
+    # import writes, and the busy timeout makes writers wait instead of failing.
+    SQLITE_WAL = True
+    SQLITE_BUSY_TIMEOUT = 5.0
+
+    # Create missing tables, columns and indexes when the app is created
+    ENSURE_SCHEMA = os.environ.get('CAR_VALUATION_ENSURE_SCHEMA', '1') == '1'
+
+    # Requests slower than this many seconds are logged with the time of every
+    # stage (see metrics.span). None turns the slow request log off.
+    SLOW_REQUEST_SECONDS = float(os.environ['CAR_VALUATION_SLOW_REQUEST_SECONDS']) \
+        if os.environ.get('CAR_VALUATION_SLOW_REQUEST_SECONDS') else None
+
+
+# Create instance of DB. It is bound to the app in create_app.
+db = SQLAlchemy()
@@ -0,0 +1,133 @@
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from selectolax.parser import HTMLParser
+
+
+# Selectors of the two regions of a detail page that hold the car data, as in get_car_info
+price_selector = 'div.Grid-cell.u-size1of2.u-textRight'
+facts_selector = 'ul.List.List--horizontal.List--bordered.u-sm-size1of1.List--allbordered.u-marginBlg'
+
+
+def start_tag_pattern(selector: str):
+    """
+    Returns a pattern of the opening tags that match selector, a tag with
+    classes. Like CSS, every class has to be a whole token of the class
+    attribute, in any order, so List does not match List--horizontal.
+    """
+    tag, *classes = selector.split('.')
+    tokens = ''.join(rf'(?=[^"]*(?<![^\s"]){re.escape(name)}(?![^\s"]))' for name in classes)
+    return re.compile(rf'<{tag}\b[^>]*?\sclass="{tokens}[^"]*"[^>]*>')
+
+
+# Opening tags of the regions, to cut them out of the raw text. Pages where they are
+# not found, e.g. because of differently quoted attributes, are parsed in full instead.
+price_start = start_tag_pattern(price_selector)
+facts_start = start_tag_pattern(facts_selector)
+div_tags = re.compile(r'<(/?)div\b', re.IGNORECASE)
+ul_tags = re.compile(r'<(/?)ul\b', re.IGNORECASE)
+
+
+def parse_number(text: str) -> int:
+    return int(text.replace(" ", ""))
+
+
+def parse_label(text: str) -> str:
+    return text.strip().lower()
+
+
+# Swedish label of a fact on the detail page -> (key in the car dict, parser of its value)
+fact_parsers = {'Mil': ('mileage', parse_number),
+                'Hästkrafter': ('hp', parse_number),
+                'Växellåda': ('gearbox', parse_label),
+                '1:a regdatum': ('traffic_date', parse_label),
+                'Antal ägare': ('owners', int),
+                'Drivmedel': ('fuel', parse_label)}
+
+# Pages are re-parsed in this many processes by default
+default_processes = os.cpu_count() or 1
+
+
+def _region(text: str, start, tags) -> str:
+    """
+    Returns the element of text whose opening tag matches start, up to its
+    balanced closing tag, or None if there is no such element.
+    """
+    match = start.search(text)
+    if match is None:
+        return None
+
+    depth = 1
+    for tag in tags.finditer(text, match.end()):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return text[match.start():text.index('>', tag.end()) + 1]
+    return None
+
+
+def extract_car(url: str, text: str) -> dict:
+    """
+    Returns the same car dict as get_car_info, from the html text of a detail page.
+
+    Only the price cell and the list of facts are parsed, each once, and the
+    rest of the page, most of its size, is skipped. Like get_car_info, every li
+    of the list is a fact with the first h5 in it as label and the first p in
+    it as value, wherever they are nested. Raises ValueError if the page has no
+    price or list of facts.
+    """
+    info = {}
+    info['id'] = int(url.split('-')[-1])
+    info['url'] = url
+
+    price_html, facts_html = _region(text, price_start, div_tags), _region(text, facts_start, ul_tags)
+    if price_html is None or facts_html is None:
+        page = HTMLParser(text)
+        price_node, facts_node = page.css_first(price_selector), page.css_first(facts_selector)
+        if price_node is None or facts_node is None:
+            raise ValueError(f"No price or car facts found on {url}")
+        price_html, facts_html = price_node.html, facts_node.html
+
+    spans = HTMLParser(price_html).tags('span')
+    if not spans:
+        raise ValueError(f"No price found on {url}")
+    info['price'] = int(spans[0].text().replace(" ", "")[:-2])
+
+    for item in HTMLParser(facts_html).tags('li'):
+        fact = fact_parsers.get(item.css_first('h5').text())
+        if fact is not None:
+            key, parse = fact
+            info[key] = parse(item.css_first('p').text())
+
+    return info
+
+
+def _extract_chunk(pages: list) -> list:
+    results = []
+    for url, text in pages:
+        try:
+            results.append((extract_car(url, text), None))
+        except (AttributeError, ValueError) as error:
+            results.append((None, f"{type(error).__name__}: {error}"))
+    return results
+
+
+def extract_pages(pages: list, processes: int = None, chunk_size: int = 100) -> list:
+    """
+    Extracts the cars from many saved detail pages, a list of (url, html text).
+
+    The pages are parsed in chunks of chunk_size in up to processes worker
+    processes (default one per core). Returns (car dict, None) for every page
+    that was parsed and (None, error message) for every page that was not, in
+    the order of pages.
+    """
+    processes = processes or default_processes
+    chunks = [pages[i:i + chunk_size] for i in range(0, len(pages), chunk_size)]
+
+    if processes == 1 or len(chunks) <= 1:
+        return [result for chunk in chunks for result in _extract_chunk(chunk)]
+
+    # Spawned workers, like the training pool, so no locks or connections are inherited
+    with ProcessPoolExecutor(max_workers=min(processes, len(chunks)),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        return [result for chunk_results in executor.map(_extract_chunk, chunks) for result in chunk_results]
@@ -0,0 +1,132 @@
+import hashlib
+import os
+import threading
+import time
+from functools import lru_cache
+from markupsafe import escape
+
+from .models import CarFacet, get_dataset_version
+
+
+# Seconds between checks of the dataset version. In between the cache answers without the database.
+check_interval = 30.0
+
+# How long browsers and proxies may reuse a dropdown response without asking again
+max_age = 60
+
+
+def options_html(values) -> str:
+    """
+    Returns the values as html option elements for a dropdown.
+    """
+    return ''.join('<option value="{0}">{0}</option>'.format(escape(value)) for value in values)
+
+
+def load_facets(session) -> dict:
+    """
+    Loads the full manufacturer -> model -> fuels/gearboxes tree from the facet
+    table and renders the html options of every dropdown up front.
+    """
+    tree = {}
+    for row in session.query(CarFacet.manufacturer, CarFacet.model, CarFacet.fuel, CarFacet.gearbox):
+        facet = tree.setdefault(row.manufacturer, {}).setdefault(row.model, {'fuels': set(), 'gearboxes': set()})
+        facet['fuels'].add(row.fuel)
+        facet['gearboxes'].add(row.gearbox)
+
+    manufacturers = sorted(tree)
+    models = {manufacturer: sorted(tree[manufacturer]) for manufacturer in manufacturers}
+    fuels, gearboxes = {}, {}
+    for manufacturer, segment_models in tree.items():
+        for model, facet in segment_models.items():
+            fuels[(manufacturer, model)] = sorted(facet['fuels'])
+            gearboxes[(manufacturer, model)] = sorted(facet['gearboxes'])
+
+    return {'manufacturers': manufacturers,
+            'models': models,
+            'fuels': fuels,
+            'gearboxes': gearboxes,
+            'models_html': {key: options_html(values) for key, values in models.items()},
+            'fuels_html': {key: options_html(values) for key, values in fuels.items()},
+            'gearboxes_html': {key: options_html(values) for key, values in gearboxes.items()}}
+
+
+class FacetCache:
+    """
+    In-process cache of the dropdown data.
+
+    The facets are reloaded only when the dataset version changes. The version
+    itself is checked at most every check_interval seconds.
+    """
+
+    def __init__(self, check_interval=check_interval):
+        self.check_interval = check_interval
+        # (version, facets), replaced as a whole so readers never see a mix
+        self.state = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, session):
+        """
+        Returns (version, facets), reloading them from the database if they are outdated.
+        """
+        state = self.state
+        if state is not None and time.monotonic() - self.checked_at < self.check_interval:
+            return state
+
+        with self._lock:
+            state = self.state
+            if state is None or time.monotonic() - self.checked_at >= self.check_interval:
+                version = get_dataset_version(session)
+                if state is None or version != state[0]:
+                    state = (version, load_facets(session))
+                    self.state = state
+                self.checked_at = time.monotonic()
+
+        return state
+
+    def clear(self):
+        """
+        Forces a reload on the next request.
+        """
+        with self._lock:
+            self.state = None
+
+
+facet_cache = FacetCache()
+
+
+@lru_cache(maxsize=1)
+def build_id() -> str:
+    """
+    Returns an identifier of the deployed page markup: CAR_VALUATION_BUILD_ID
+    if it is set (e.g. the git commit), otherwise a hash of the templates and
+    static files. It is computed once per process.
+    """
+    if os.environ.get('CAR_VALUATION_BUILD_ID'):
+        return os.environ['CAR_VALUATION_BUILD_ID']
+
+    digest = hashlib.sha1()
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    for folder in ['templates', 'static']:
+        for root, dirs, files in sorted(os.walk(os.path.join(app_dir, folder))):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, app_dir).encode('utf-8'))
+                with open(path, 'rb') as file:
+                    digest.update(file.read())
+    return digest.hexdigest()[:12]
+
+
+def cached_response(response, request, version, build: str = None):
+    """
+    Adds an ETag for the dataset version and Cache-Control headers to response
+    and turns it into a 304 if the client already has this version.
+
+    Pages rendered from templates pass build (see build_id), so that a deploy
+    that changes the markup but not the data is not answered with a 304.
+    """
+    response.set_etag(f"facets-{version}" if build is None else f"facets-{version}-{build}")
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
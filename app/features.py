@@ -0,0 +1,93 @@
+import datetime
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import MinMaxScaler
+
+
+# Numerical columns in the order the scaler was fitted on, see model_registry.train_artifact
+numerical_cols = ['mileage', 'hp', 'car_age', 'owners']
+
+# Categorical columns that load_and_transform_data turns into dummy variables
+categorical_cols = ['gearbox', 'fuel']
+
+
+class FeatureEncoder:
+    """
+    Encodes new cars to the feature layout of a trained segment.
+
+    It is the compiled equivalent of transform_new_data. The column order, the
+    dummy variable vocabularies and the min-max scaler parameters are kept as
+    plain NumPy arrays and dicts, so encoding writes straight into a float array
+    without building any DataFrames.
+    """
+
+    def __init__(self, columns: list, scaler: MinMaxScaler):
+        """
+        columns are the columns of the training data X (as returned by
+        load_and_transform_data) and scaler is the MinMaxScaler fitted on its
+        numerical columns.
+        """
+        self.columns = list(columns)
+        self.n_features = len(self.columns)
+
+        # Position of each numerical column in the output and its scaling
+        self.numerical_index = np.array([self.columns.index(col) for col in numerical_cols])
+        self.scale = np.asarray(scaler.scale_, dtype=np.float64)
+        self.offset = np.asarray(scaler.min_, dtype=np.float64)
+
+        # Category value -> output column for every dummy variable. Values that
+        # were dropped (first category) or never seen map to all zeros.
+        self.vocabularies = {col: {} for col in categorical_cols}
+        for i, name in enumerate(self.columns):
+            for col in categorical_cols:
+                prefix = f"{col}_"
+                if name.startswith(prefix):
+                    self.vocabularies[col][name[len(prefix):]] = i
+
+    @staticmethod
+    def car_age(traffic_dates) -> np.ndarray:
+        """
+        Returns the age in years of cars with traffic_dates, computed like
+        load_and_transform_data does (whole days since the traffic date / 365).
+        """
+        try:
+            dates = np.asarray(traffic_dates, dtype='datetime64[D]')
+        except ValueError:
+            # Formats NumPy does not understand are left to pandas
+            dates = pd.to_datetime(pd.Series(traffic_dates)).to_numpy().astype('datetime64[D]')
+
+        today = np.datetime64(datetime.date.today(), 'D')
+        return (today - dates).astype(np.float64) / 365
+
+    def encode(self, new_data: dict, out=None) -> np.ndarray:
+        """
+        Encodes new_data, a dict of equally long lists with the keys mileage, hp,
+        traffic_date, owners, gearbox and fuel, to a float array of shape
+        (n_cars, n_features). A preallocated array can be passed as out.
+        """
+        n = len(new_data['mileage'])
+
+        if out is None:
+            out = np.zeros((n, self.n_features), dtype=np.float64)
+        else:
+            out[:n] = 0.0
+
+        numerical = np.empty((n, len(numerical_cols)), dtype=np.float64)
+        numerical[:, 0] = new_data['mileage']
+        numerical[:, 1] = new_data['hp']
+        numerical[:, 2] = self.car_age(new_data['traffic_date'])
+        numerical[:, 3] = new_data['owners']
+
+        # Same operations as MinMaxScaler.transform
+        numerical *= self.scale
+        numerical += self.offset
+        out[:n, self.numerical_index] = numerical
+
+        for col, vocabulary in self.vocabularies.items():
+            if not vocabulary:
+                continue
+            index = np.fromiter((vocabulary.get(value, -1) for value in new_data[col]), dtype=np.intp, count=n)
+            rows = np.flatnonzero(index >= 0)
+            out[rows, index[rows]] = 1.0
+
+        return out[:n]
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class FlatForest:
+    """
+    A fitted RandomForestRegressor stored as flat numpy arrays, one entry per node
+    of all trees.
+
+    sklearn copies the nodes of every tree into memory of its own when a forest
+    is unpickled, so each gunicorn worker would hold a private copy of each forest.
+    FlatForest predicts from its arrays as they are. An artifact loaded with joblib
+    mmap_mode therefore reads them straight from the file, and all workers share
+    the pages through the page cache.
+
+    predict gives the same prices as the forest it was built from.
+    """
+
+    def __init__(self, forest):
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        sizes = np.array([tree.node_count for tree in trees])
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+        lefts, rights, features, thresholds, values = [], [], [], [], []
+        for tree, offset in zip(trees, offsets):
+            nodes = np.arange(tree.node_count) + offset
+            leaf = tree.children_left == -1
+
+            # Leaves point to themselves, so that every row can take the same number of steps
+            lefts.append(np.where(leaf, nodes, tree.children_left + offset))
+            rights.append(np.where(leaf, nodes, tree.children_right + offset))
+            features.append(np.where(leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            values.append(tree.value[:, 0, 0])
+
+        self.roots = offsets.astype(np.int32)
+        self.left = np.concatenate(lefts).astype(np.int32)
+        self.right = np.concatenate(rights).astype(np.int32)
+        self.feature = np.concatenate(features).astype(np.int32)
+        self.threshold = np.concatenate(thresholds).astype(np.float64)
+        self.value = np.concatenate(values).astype(np.float64)
+        self.depth = max(tree.max_depth for tree in trees)
+        self.n_features_in_ = forest.n_features_in_
+
+    @property
+    def n_estimators(self) -> int:
+        return len(self.roots)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in [self.roots, self.left, self.right, self.feature, self.threshold, self.value])
+
+    def predict(self, X):
+        """
+        Returns the mean prediction of the trees for every row of X.
+        """
+        # sklearn compares float32 features with the float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(X.shape[0])
+
+        # One current node per tree and row, all trees are walked down together
+        nodes = np.repeat(self.roots[:, np.newaxis], X.shape[0], axis=1)
+        for _ in range(self.depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+        return self.value[nodes].mean(axis=0)
@@ -0,0 +1,163 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the latency histogram buckets
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# Metrics of this process in the order they are rendered
+_metrics = []
+# Functions returning (name, type, help, [(labels, value)]) for values kept elsewhere, e.g. cache stats
+_collectors = []
+
+# Stages timed during the request handled by the current thread, see start_request
+_request = threading.local()
+
+
+def _label_text(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, escaped)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """
+    Monotonically increasing count, optionally split by labels.
+    """
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_label_text(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, optionally split by labels.
+    """
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = list(buckets)
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ['+Inf'], counts):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+def register_collector(collector):
+    """
+    Adds a function that returns metrics kept elsewhere as a list of
+    (name, type, help, [(labels dict, value)]) when /metrics is rendered.
+    """
+    _collectors.append(collector)
+
+
+def render() -> str:
+    """
+    Returns all metrics of this process in the Prometheus text format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    for collector in _collectors:
+        for name, metric_type, help, samples in collector():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_label_text(tuple(labels), tuple(labels.values()))} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+
+request_seconds = Histogram('car_valuation_request_seconds', 'Time to answer a request.', ['endpoint'])
+requests_total = Counter('car_valuation_requests_total', 'Answered requests.', ['endpoint', 'status'])
+stage_seconds = Histogram('car_valuation_stage_seconds', 'Time spent in one stage of a request or training run.', ['stage'])
+training_runs = Counter('car_valuation_training_runs_total', 'Model training runs by outcome.', ['outcome'])
+rows_loaded = Counter('car_valuation_rows_loaded_total', 'Car rows loaded from the database for training.')
+
+
+def start_request():
+    """
+    Starts collecting the stages of the request handled by this thread.
+    """
+    _request.stages = []
+    _request.start = time.perf_counter()
+
+
+def finish_request() -> tuple:
+    """
+    Stops collecting and returns (seconds since start_request, [(stage, seconds)]).
+    """
+    stages = getattr(_request, 'stages', None) or []
+    seconds = time.perf_counter() - getattr(_request, 'start', time.perf_counter())
+    _request.stages = None
+    return seconds, stages
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Times the block as stage, both in the stage histogram and in the breakdown
+    of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def observe_stage(stage: str, seconds: float):
+    """
+    Records seconds spent in stage, e.g. for stages timed in another process.
+    """
+    stage_seconds.observe(seconds, stage=stage)
+    stages = getattr(_request, 'stages', None)
+    if stages is not None:
+        stages.append((stage, seconds))
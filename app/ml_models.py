@@ -1,12 +1,18 @@
-import matplotlib.pyplot as plt
-import pandas as pd
-
+import itertools
+import pickle
+import statistics
+import time
+from joblib import parallel_config
 from sklearn import linear_model, metrics
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import KFold, cross_val_score, train_test_split
+from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import PolynomialFeatures
 
 
+# random_forest_model and polynomial_model are the original train/validation split
+# helpers. They are kept, unchanged, for app/old_routes.py; the app uses the
+# cross validated helpers below.
 def random_forest_model(X, y, test_size=0.2, n_estimators=1000, random_state=1):
     """
     Does random forest regression with sklearn. 
@@ -54,4 +60,109 @@ def polynomial_model(X, y, test_size=0.2):
     MAE = metrics.mean_absolute_error(y_valid, y_pred)
     MAPE = metrics.mean_absolute_percentage_error(y_valid, y_pred)
 
-    return model, MAE, MAPE
\ No newline at end of file
+    return model, MAE, MAPE
+
+
+def random_forest_regressor(n_estimators=1000, max_depth=None, min_samples_leaf=1, random_state=1):
+    """
+    Returns an unfitted random forest regressor.
+    """
+    return RandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth,
+                                 min_samples_leaf=min_samples_leaf, random_state=random_state)
+
+
+def polynomial_regressor(degree=2):
+    """
+    Returns an unfitted polynomial regression. The polynomial features are part
+    of the pipeline, so fitting and predicting take the encoded features directly.
+    """
+    return make_pipeline(PolynomialFeatures(degree), linear_model.LinearRegression())
+
+
+def cross_validated_mape(model, X, y, n_splits=5, random_state=1, n_jobs=None) -> float:
+    """
+    Returns the mean absolute percentage error (MAPE) of model over K shuffled folds of X, y.
+
+    The folds only depend on random_state, so the result is the same on every call.
+    The folds are fitted in parallel with n_jobs threads. Tree building and the
+    least squares solver release the GIL, and threads do not copy X or leave
+    worker processes behind in the training process.
+    """
+    folds = KFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    with parallel_config(backend='threading'):
+        scores = cross_val_score(model, X, y, cv=folds, scoring='neg_mean_absolute_percentage_error', n_jobs=n_jobs)
+
+    return float(-scores.mean())
+
+
+def predict_latency(model, X, repeats=20) -> float:
+    """
+    Returns the median time in seconds model takes to predict one row of X.
+    """
+    row = X[:1]
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict(row)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def tune_random_forest(X, y, grid: dict, n_splits=5, tolerance=0.02, max_latency=None, max_size=None, n_jobs=None):
+    """
+    Searches the random forest settings in grid (lists of n_estimators, max_depth
+    and min_samples_leaf) on X, y.
+
+    Every candidate is scored with cross_validated_mape and then fitted on all rows
+    to measure its fit time, predict latency for one row and pickled size. Of the
+    candidates within max_latency (seconds) and max_size (bytes), the smallest one
+    whose MAPE is at most (1 + tolerance) times the best MAPE is returned.
+
+    Returns the fitted model, its MAPE and a list with one report dict per candidate.
+    """
+    report = []
+    models = []
+
+    for n_estimators, max_depth, min_samples_leaf in itertools.product(grid['n_estimators'], grid['max_depth'], grid['min_samples_leaf']):
+        model = random_forest_regressor(n_estimators=n_estimators, max_depth=max_depth, min_samples_leaf=min_samples_leaf)
+        MAPE = cross_validated_mape(model, X, y, n_splits=n_splits, n_jobs=n_jobs)
+
+        start = time.perf_counter()
+        model.fit(X, y)
+        fit_time = time.perf_counter() - start
+
+        latency = predict_latency(model, X)
+        size = len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+
+        report.append({'n_estimators': n_estimators,
+                       'max_depth': max_depth,
+                       'min_samples_leaf': min_samples_leaf,
+                       'MAPE': MAPE,
+                       'fit_time': fit_time,
+                       'predict_latency': latency,
+                       'size': size,
+                       'within_budget': (max_latency is None or latency <= max_latency) and (max_size is None or size <= max_size)})
+        models.append(model)
+
+    # If no candidate meets the budget, the budget is ignored rather than failing the training
+    eligible = [i for i, result in enumerate(report) if result['within_budget']] or list(range(len(report)))
+    best_MAPE = min(report[i]['MAPE'] for i in eligible)
+    chosen = min((i for i in eligible if report[i]['MAPE'] <= best_MAPE * (1 + tolerance)), key=lambda i: report[i]['size'])
+
+    for i, result in enumerate(report):
+        result['chosen'] = i == chosen
+
+    return models[chosen], report[chosen]['MAPE'], report
+
+
+def print_tuning_report(report: list):
+    """
+    Prints one line per candidate of tune_random_forest.
+    """
+    print(f"{'trees':>6} {'depth':>6} {'leaf':>5} {'MAPE':>7} {'fit s':>7} {'predict ms':>11} {'size MB':>8}")
+    for result in report:
+        print(f"{result['n_estimators']:>6} {str(result['max_depth']):>6} {result['min_samples_leaf']:>5} "
+              f"{result['MAPE']:7.4f} {result['fit_time']:7.2f} {result['predict_latency'] * 1e3:11.2f} "
+              f"{result['size'] / 1e6:8.2f}"
+              f"{'  <- chosen' if result['chosen'] else ''}{'' if result['within_budget'] else '  (over budget)'}")
@@ -0,0 +1,373 @@
+import hashlib
+import joblib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from sklearn.preprocessing import MinMaxScaler
+
+from .features import FeatureEncoder, numerical_cols
+from .forest import FlatForest
+from .metrics import register_collector, span
+from .models import get_segment_versions
+from .polynomial import PolynomialRegression
+from .prediction_cache import prediction_cache
+from .ml_models import (cross_validated_mape, polynomial_regressor, print_tuning_report, random_forest_regressor,
+                        tune_random_forest)
+
+
+# Directory where the trained artifacts are stored, one file per (manufacturer, model)
+model_dir = os.environ.get('CAR_VALUATION_MODEL_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trained_models'))
+
+# Bumped whenever the layout of the artifact changes, older artifacts are retrained
+artifact_version = 6
+
+# Number of folds used to compare the models of a segment, and the number of
+# threads that fit them in parallel
+cv_folds = 5
+cv_jobs = int(os.environ.get('CAR_VALUATION_CV_JOBS', cv_folds))
+
+# Tuning mode searches the random forest settings per segment instead of using
+# the default forest. The smallest forest whose MAPE is within rf_tolerance
+# (relative) of the best one, and that predicts a car within rf_max_latency
+# seconds and pickles to at most rf_max_size bytes, is kept.
+rf_tuning = os.environ.get('CAR_VALUATION_RF_TUNING', '0') == '1'
+rf_grid = {'n_estimators': [50, 100, 300],
+           'max_depth': [None, 12, 20],
+           'min_samples_leaf': [1, 3, 5]}
+rf_tolerance = float(os.environ.get('CAR_VALUATION_RF_TOLERANCE', 0.02))
+rf_max_latency = float(os.environ.get('CAR_VALUATION_RF_MAX_LATENCY', 0.05))
+rf_max_size = int(os.environ.get('CAR_VALUATION_RF_MAX_SIZE', 50_000_000))
+
+# Short names of the model types in metric labels
+stage_names = {'random forest-modell': 'random_forest', 'polynom-modell': 'polynomial'}
+
+# Seconds between reloads of the segment versions. In between, models and cached
+# predictions are looked up without the database, and new cars are noticed this late.
+version_check_interval = float(os.environ.get('CAR_VALUATION_VERSION_CHECK_INTERVAL', 10.0))
+
+# Memory budget in bytes of the artifacts each process keeps loaded
+model_cache_bytes = int(os.environ.get('CAR_VALUATION_MODEL_CACHE_MB', 512)) * 1024 ** 2
+
+class ArtifactCache:
+    """
+    Loaded artifacts of this process, keyed on (manufacturer, model), with a
+    memory budget and least recently used eviction.
+
+    An artifact is charged with the size of its file. Artifacts are loaded memory
+    mapped, so most of that memory is page cache shared with the other workers,
+    but it still has to fit in RAM to be fast.
+    """
+
+    def __init__(self, max_bytes: int = model_cache_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, fingerprint: str):
+        """
+        Returns the artifact for key if it was trained on the rows with fingerprint, otherwise None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and is_current(entry[0], fingerprint):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, artifact: dict, nbytes: int):
+        """
+        Adds artifact for key and evicts the least recently used artifacts until
+        the cache fits its budget again. The newest artifact is always kept.
+        """
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.resident_bytes -= old[1]
+
+            self.entries[key] = (artifact, nbytes)
+            self.resident_bytes += nbytes
+
+            while self.resident_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.resident_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the hit rate, hits, misses, evictions, number of artifacts and
+        resident bytes of the cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'artifacts': len(self.entries),
+                    'resident_bytes': self.resident_bytes,
+                    'max_bytes': self.max_bytes}
+
+
+model_cache = ArtifactCache()
+
+
+def model_cache_metrics() -> list:
+    stats = model_cache.stats()
+    return [('car_valuation_model_cache_hits_total', 'counter', 'Artifact lookups answered from memory.', [({}, stats['hits'])]),
+            ('car_valuation_model_cache_misses_total', 'counter', 'Artifact lookups that went to disk or training.', [({}, stats['misses'])]),
+            ('car_valuation_model_cache_evictions_total', 'counter', 'Artifacts dropped to stay in the memory budget.', [({}, stats['evictions'])]),
+            ('car_valuation_model_cache_artifacts', 'gauge', 'Artifacts loaded in this process.', [({}, stats['artifacts'])]),
+            ('car_valuation_model_cache_resident_bytes', 'gauge', 'Bytes of the loaded artifacts.', [({}, stats['resident_bytes'])])]
+
+
+register_collector(model_cache_metrics)
+
+
+def artifact_path(manufacturer: str, model: str) -> str:
+    """
+    Returns the file path of the artifact for manufacturer and model.
+
+    The names are sanitized for the file system and a short hash is appended
+    so that two segments never map to the same file.
+    """
+    name = re.sub(r'[^A-Za-z0-9_-]+', '_', f"{manufacturer}__{model}")
+    digest = hashlib.sha1(f"{manufacturer}\x00{model}".encode('utf-8')).hexdigest()[:8]
+    return os.path.join(model_dir, f"{name}-{digest}.joblib")
+
+
+class SegmentVersionCache:
+    """
+    In-process copy of the segment_version table.
+
+    All versions are loaded with one small query, at most every check_interval
+    seconds, like FacetCache does for the dropdowns. The car table is never read.
+    """
+
+    def __init__(self, check_interval=version_check_interval):
+        self.check_interval = check_interval
+        self.versions = None
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, session, manufacturer: str, model: str) -> tuple:
+        """
+        Returns (version, ingest_id) of the segment, None if it has no cars.
+        """
+        versions = self.versions
+        if versions is None or time.monotonic() - self.loaded_at >= self.check_interval:
+            with self._lock:
+                if self.versions is None or time.monotonic() - self.loaded_at >= self.check_interval:
+                    self.versions = get_segment_versions(session)
+                    self.loaded_at = time.monotonic()
+                versions = self.versions
+
+        return versions.get((manufacturer, model))
+
+    def clear(self):
+        """
+        Forces a reload on the next lookup, e.g. after cars were ingested in this process.
+        """
+        with self._lock:
+            self.versions = None
+
+
+segment_versions = SegmentVersionCache()
+
+
+def segment_fingerprint(manufacturer: str, model: str, db) -> str:
+    """
+    Returns the fingerprint of the cars of manufacturer and model, taken from
+    the segment version that is bumped whenever cars of the segment are
+    ingested (see models.insert_cars). A trained model is rebuilt when it changes.
+    Returns None if there are no cars of manufacturer and model.
+    """
+    segment = segment_versions.get(db.session, manufacturer, model)
+    if segment is None:
+        return None
+    version, ingest_id = segment
+    return f"{version}-{ingest_id}"
+
+
+def train_artifact(X, y, tuning=None) -> dict:
+    """
+    Compares the random forest and polynomial models on X, y with K-fold cross
+    validation and returns an artifact with the best model (by MAPE), fitted on
+    all rows, and the feature encoder for new data.
+
+    With tuning (default rf_tuning) the random forest is the one chosen by
+    tune_random_forest, and the tuning report is stored in the artifact.
+    """
+    X = X.copy()
+
+    # Scale the numerical variables with a min-max scaler
+    scaler = MinMaxScaler()
+    X[numerical_cols] = scaler.fit_transform(X[numerical_cols])
+
+    # The models are fitted on plain arrays, which is what the encoder produces
+    encoder = FeatureEncoder(X.columns, scaler)
+    X_array, y_array = X.to_numpy(dtype=float), y.to_numpy(dtype=float)
+
+    # Small segments get one fold per car
+    n_splits = min(cv_folds, len(y_array))
+    tuning = rf_tuning if tuning is None else tuning
+
+    candidates = {'polynom-modell': polynomial_regressor()}
+    cv_MAPE = {}
+    tuning_report = None
+    # Seconds per training stage, reported as metrics by the process that serves the model
+    timings = {}
+
+    if tuning:
+        # The tuned forest is already fitted on all rows
+        start = time.perf_counter()
+        rfm, cv_MAPE['random forest-modell'], tuning_report = tune_random_forest(
+            X_array, y_array, rf_grid, n_splits=n_splits, tolerance=rf_tolerance,
+            max_latency=rf_max_latency, max_size=rf_max_size, n_jobs=cv_jobs)
+        timings['train_tune_random_forest'] = time.perf_counter() - start
+        print_tuning_report(tuning_report)
+    else:
+        candidates['random forest-modell'] = random_forest_regressor()
+
+    for model_type, candidate in candidates.items():
+        start = time.perf_counter()
+        cv_MAPE[model_type] = cross_validated_mape(candidate, X_array, y_array, n_splits=n_splits, n_jobs=cv_jobs)
+        timings[f"train_cv_{stage_names[model_type]}"] = time.perf_counter() - start
+
+    # Keep the best performing model based on mean absolute percentage error
+    model_type = min(cv_MAPE, key=cv_MAPE.get)
+    if tuning and model_type == 'random forest-modell':
+        model = rfm
+    else:
+        start = time.perf_counter()
+        model = candidates[model_type].fit(X_array, y_array)
+        timings[f"train_fit_{stage_names[model_type]}"] = time.perf_counter() - start
+
+    # The models are stored in forms that predict straight from numpy arrays,
+    # see FlatForest and PolynomialRegression
+    if model_type == 'random forest-modell':
+        model = FlatForest(model)
+    else:
+        model = PolynomialRegression(model)
+
+    return {'version': artifact_version,
+            'model': model,
+            'model_type': model_type,
+            'MAPE': cv_MAPE[model_type],
+            'cv_MAPE': cv_MAPE,
+            'cv_folds': n_splits,
+            'rf_tuning': tuning_report,
+            'timings': timings,
+            'encoder': encoder,
+            'n_cars': X.shape[0]}
+
+
+def load_artifact(manufacturer: str, model: str):
+    """
+    Loads the stored artifact for manufacturer and model. Returns None if there is none.
+
+    The numpy arrays of the artifact are memory mapped read-only from the file.
+    """
+    path = artifact_path(manufacturer, model)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        return joblib.load(path, mmap_mode='r')
+    except Exception as e:
+        print(f"Could not load model artifact {path}: {e}")
+        return None
+
+
+def save_artifact(manufacturer: str, model: str, artifact: dict):
+    """
+    Saves the artifact for manufacturer and model to disk.
+
+    The artifact is written to a temporary file first and then moved in place,
+    so that other workers never read a half written file. It is not compressed,
+    so that its arrays can be memory mapped.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    path = artifact_path(manufacturer, model)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(artifact, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def is_current(artifact, fingerprint: str) -> bool:
+    """
+    Returns True if artifact has the current layout and was trained on the rows with fingerprint.
+    """
+    return (artifact is not None
+            and artifact.get('version') == artifact_version
+            and artifact['fingerprint'] == fingerprint)
+
+
+def cached_artifact(manufacturer: str, model: str, fingerprint: str):
+    """
+    Returns the artifact for manufacturer and model from memory or disk if it was
+    trained on the rows with fingerprint. Returns None if it has to be (re)trained.
+    """
+    key = (manufacturer, model)
+
+    artifact = model_cache.get(key, fingerprint)
+    if artifact is not None:
+        return artifact
+
+    artifact = load_artifact(manufacturer, model)
+    if is_current(artifact, fingerprint):
+        model_cache.put(key, artifact, os.path.getsize(artifact_path(manufacturer, model)))
+        return artifact
+
+    return None
+
+
+def remember_artifact(manufacturer: str, model: str, artifact: dict):
+    """
+    Keeps a freshly trained artifact in memory for this process and drops the
+    cached predictions of the segment.
+
+    The artifact is read back from disk memory mapped, so that the process
+    shares it with the other workers instead of keeping its own copy.
+    """
+    stored = load_artifact(manufacturer, model)
+    if stored is not None and stored.get('fingerprint') == artifact.get('fingerprint'):
+        artifact = stored
+
+    model_cache.put((manufacturer, model), artifact, os.path.getsize(artifact_path(manufacturer, model)))
+
+    # Cached predictions of the old model are keyed on its fingerprint and
+    # can never be hit again, so they are dropped right away
+    prediction_cache.invalidate(manufacturer, model)
+
+
+def train_and_save_artifact(manufacturer: str, model: str, X, y, fingerprint: str) -> dict:
+    """
+    Trains the artifact for manufacturer and model on X, y and stores it on disk.
+    """
+    print(f"Training models for {manufacturer} {model}.")
+    artifact = train_artifact(X, y)
+    artifact['fingerprint'] = fingerprint
+    save_artifact(manufacturer, model, artifact)
+    return artifact
+
+
+def predict_with_artifact(artifact: dict, new_data: dict):
+    """
+    Predicts the price of the cars in new_data (dict of lists, see FeatureEncoder.encode)
+    with the model in artifact. Returns an array of predicted prices.
+    """
+    with span('encode'):
+        X_new = artifact['encoder'].encode(new_data)
+
+    with span('predict'):
+        return artifact['model'].predict(X_new)
@@ -1,9 +1,21 @@
 import csv
-from .config import app, db
+import datetime
+import time
+import uuid
+from itertools import islice
+from sqlalchemy import delete, func, insert, inspect, select, text, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .config import db
 
 # Database model repr as python class
 # Fields will be translated to cols in Db
 class Car(db.Model):
+    # Lookups are always by manufacturer and model, and then fuel and gearbox
+    __table_args__ = (
+        db.Index('ix_car_manufacturer_model_fuel_gearbox', 'manufacturer', 'model', 'fuel', 'gearbox'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
 
     car_id = db.Column(db.Integer, nullable=False)
@@ -28,34 +40,313 @@ class Car(db.Model):
 
     model = db.Column(db.String(128), nullable=False)
 
+    # Set when the listing is no longer on the site. The car is kept as training data.
+    delisted_at = db.Column(db.DateTime, nullable=True)
+
+
+# Precomputed dropdown data: one row per manufacturer, model, fuel and gearbox
+# combination with the number of cars. Rebuilt by refresh_facets after ingestion.
+class CarFacet(db.Model):
+    manufacturer = db.Column(db.String(128), primary_key=True)
+
+    model = db.Column(db.String(128), primary_key=True)
+
+    fuel = db.Column(db.String(128), primary_key=True)
+
+    gearbox = db.Column(db.String(128), primary_key=True)
+
+    n_cars = db.Column(db.Integer, nullable=False)
+
+
+# Single row with a counter that is bumped every time the facets are rebuilt.
+# Caches of the dropdown data compare it to know when to reload.
+class DatasetVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# One row per manufacturer and model with a counter that is bumped every time
+# cars of the segment are inserted. Trained models are keyed on it, see
+# model_registry.segment_fingerprint. ingest_id tells apart equal counters of a
+# rebuilt database.
+class SegmentVersion(db.Model):
+    manufacturer = db.Column(db.String(128), primary_key=True)
 
-def populate_database(path):
+    model = db.Column(db.String(128), primary_key=True)
+
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    ingest_id = db.Column(db.String(32), nullable=False)
+
+
+# Insert statements with ON CONFLICT clauses, per database the app can store its cars in
+conflict_inserts = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+
+def conflict_insert(connection, table):
     """
-    Populates database with entries from csv file in path.
+    Returns an insert into table with on_conflict_do_nothing/on_conflict_do_update
+    for the database of connection. Raises ValueError for other databases.
     """
-    with app.app_context():
-        with open(path, 'r') as file:
-            reader = csv.DictReader(file, delimiter='\t')
-            for row in reader:
-                car = Car(car_id=row['id'], 
-                        url=row['url'], 
-                        price=row['price'],
-                        mileage=row['mileage'],
-                        hp=row['hp'],
-                        gearbox=row['gearbox'],
-                        traffic_date=row['traffic_date'],
-                        owners=row['owners'],
-                        fuel=row['fuel'],
-                        manufacturer=row['manufacturer'],
-                        model=row['model'])
-                db.session.add(car)
-
-        db.session.commit()         
+    dialect = connection.dialect.name
+    if dialect not in conflict_inserts:
+        raise ValueError(f"Cars can only be stored in {' or '.join(conflict_inserts)}, not {dialect}.")
+    return conflict_inserts[dialect](table)
+
+
+def get_dataset_version(session=None) -> int:
+    """
+    Returns the current dataset version, 0 if the facets were never built.
+    """
+    session = session or db.session
+    version = session.query(DatasetVersion.version).filter_by(id=1).scalar()
+    return version or 0
+
+
+def bump_segment_versions(connection, segments):
+    """
+    Bumps the version of every (manufacturer, model) in segments, creating
+    missing rows. Called in the transaction that changed the cars of the segments.
+    """
+    segments = set(segments)
+    if not segments:
+        return
+
+    table = SegmentVersion.__table__
+    ingest_id = uuid.uuid4().hex
+    statement = conflict_insert(connection, table).values(
+        [{'manufacturer': manufacturer, 'model': model, 'version': 1, 'ingest_id': ingest_id}
+         for manufacturer, model in segments])
+    connection.execute(statement.on_conflict_do_update(index_elements=['manufacturer', 'model'],
+                                                       set_={'version': table.c.version + 1, 'ingest_id': ingest_id}))
+
+
+def get_segment_versions(session=None) -> dict:
+    """
+    Returns {(manufacturer, model): (version, ingest_id)} for every segment with cars.
+    """
+    session = session or db.session
+    rows = session.query(SegmentVersion.manufacturer, SegmentVersion.model,
+                         SegmentVersion.version, SegmentVersion.ingest_id)
+    return {(manufacturer, model): (version, ingest_id) for manufacturer, model, version, ingest_id in rows}
+
+
+def refresh_facets():
+    """
+    Rebuilds the car_facet table from the car table in one transaction and bumps
+    the dataset version. Needs to be called whenever cars are ingested.
+    """
+    grouped = select(Car.manufacturer, Car.model, Car.fuel, Car.gearbox, func.count(Car.id)).group_by(
+        Car.manufacturer, Car.model, Car.fuel, Car.gearbox)
+
+    db.session.execute(delete(CarFacet))
+    db.session.execute(insert(CarFacet).from_select(
+        ['manufacturer', 'model', 'fuel', 'gearbox', 'n_cars'], grouped))
+
+    bumped = db.session.execute(update(DatasetVersion).where(DatasetVersion.id == 1).values(
+        version=DatasetVersion.version + 1))
+    if bumped.rowcount == 0:
+        db.session.add(DatasetVersion(id=1, version=1))
+
+    db.session.commit()
+
+
+def ensure_schema():
+    """
+    Creates missing tables and indexes, also on a database created by an older
+    version of the app, and fills the facet table if it is empty.
+    """
+    db.create_all()
+
+    # Columns added after the first version of the car table
+    existing = {column['name'] for column in inspect(db.engine).get_columns(Car.__tablename__)}
+    if 'delisted_at' not in existing:
+        with db.engine.begin() as connection:
+            column_type = Car.__table__.c.delisted_at.type.compile(connection.dialect)
+            connection.execute(text(f"ALTER TABLE {Car.__tablename__} ADD COLUMN delisted_at {column_type}"))
+
+    # create_all only creates indexes together with their table
+    for index in Car.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+    if db.session.query(CarFacet).first() is None and db.session.query(Car).first() is not None:
+        refresh_facets()
+
+    # Segments of a database from before the segment versions start at version 1
+    if db.session.query(SegmentVersion).first() is None:
+        segments = db.session.execute(select(Car.manufacturer, Car.model).distinct()).all()
+        bump_segment_versions(db.session.connection(), [tuple(segment) for segment in segments])
+        db.session.commit()
+
+
+def segment_car_ids(manufacturer: str, model: str) -> dict:
+    """
+    Returns {car_id: delisted_at} for every stored car of manufacturer and model, in one query.
+    """
+    rows = db.session.execute(select(Car.car_id, Car.delisted_at).where(
+        Car.manufacturer == manufacturer, Car.model == model))
+    return {car_id: delisted_at for car_id, delisted_at in rows}
+
+
+def update_listing_status(manufacturer: str, model: str, listed_ids, known: dict = None) -> dict:
+    """
+    Marks stored cars of manufacturer and model that are not in listed_ids as
+    delisted, and cars that are listed again as listed. known is the result of
+    segment_car_ids if it was already queried.
+
+    Returns the number of cars that were delisted and relisted.
+    """
+    if known is None:
+        known = segment_car_ids(manufacturer, model)
+
+    listed_ids = set(listed_ids)
+    delisted = [car_id for car_id, delisted_at in known.items() if delisted_at is None and car_id not in listed_ids]
+    relisted = [car_id for car_id, delisted_at in known.items() if delisted_at is not None and car_id in listed_ids]
+
+    now = datetime.datetime.now()
+    segment = (Car.manufacturer == manufacturer, Car.model == model)
+    # Chunks keep the IN lists below the SQLite parameter limit
+    for i in range(0, len(delisted), 500):
+        db.session.execute(update(Car).where(*segment, Car.car_id.in_(delisted[i:i + 500])).values(delisted_at=now))
+    for i in range(0, len(relisted), 500):
+        db.session.execute(update(Car).where(*segment, Car.car_id.in_(relisted[i:i + 500])).values(delisted_at=None))
+
+    db.session.commit()
+
+    return {'delisted': len(delisted), 'relisted': len(relisted)}
+
+
+# Fields of a scraped car or a backup row. 'id' is the listing id, stored as car_id.
+car_fields = ['id', 'url', 'price', 'mileage', 'hp', 'gearbox', 'traffic_date', 'owners', 'fuel', 'manufacturer', 'model']
+int_fields = ['id', 'price', 'mileage', 'hp', 'owners']
+
+
+def car_row(car: dict) -> dict:
+    """
+    Converts a scraped car or backup row to a row of the car table.
+    Raises KeyError or ValueError if a field is missing or not a number.
+    """
+    row = {('car_id' if field == 'id' else field): car[field] for field in car_fields}
+    for field in int_fields:
+        column = 'car_id' if field == 'id' else field
+        row[column] = int(row[column])
+    return row
+
+
+def insert_cars(connection, rows: list) -> int:
+    """
+    Inserts rows of the car table with one executemany, skipping urls that are
+    already stored, and bumps the versions of the segments that got new cars.
+    Returns the number of inserted rows.
+    """
+    if not rows:
+        return 0
+
+    # Core insert on the table, so no ORM objects are built. Only inserted rows are returned.
+    statement = conflict_insert(connection, Car.__table__).on_conflict_do_nothing(index_elements=['url']).returning(
+        Car.manufacturer, Car.model)
+    inserted = connection.execute(statement, rows).all()
+    bump_segment_versions(connection, [tuple(segment) for segment in inserted])
+    return len(inserted)
+
+
+def save_cars(cars: list) -> int:
+    """
+    Inserts scraped cars (dicts from get_car_info with manufacturer and model)
+    in the car table. Incomplete dicts and urls that are already stored are skipped.
+
+    Returns the number of inserted cars.
+    """
+    rows = [car_row(car) for car in cars if all(field in car for field in car_fields)]
+    inserted = insert_cars(db.session.connection(), rows)
+    db.session.commit()
+
+    return inserted
+
+
+def bulk_import(path: str, chunk_size=10000) -> dict:
+    """
+    Imports the cars in the tab separated backup file at path into the car table.
+
+    The file is streamed in chunks of chunk_size rows, and every chunk is
+    inserted with one executemany inside a single transaction. For the duration of
+    the import SQLite does not sync to disk and, unless the database is in WAL
+    mode, keeps its journal in memory, so a crash during the import can leave the
+    database broken; it is meant for rebuilding the database from a backup. Rows with a url that is already stored,
+    or with malformed fields, are skipped.
+
+    Returns the number of rows read, inserted and skipped and the rows per second.
+    """
+    start = time.perf_counter()
+    n_rows, inserted = 0, 0
+
+    with db.engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            synchronous = connection.exec_driver_sql("PRAGMA synchronous").scalar()
+            journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+            connection.exec_driver_sql("PRAGMA synchronous = OFF")
+            # A database in WAL mode stays in it: leaving WAL needs exclusive access,
+            # and WAL already appends the whole transaction sequentially.
+            if journal_mode != 'wal':
+                connection.exec_driver_sql("PRAGMA journal_mode = MEMORY")
+            connection.commit()
+
+        try:
+            with open(path, 'r', newline='') as file:
+                reader = csv.DictReader(file, delimiter='\t')
+                while True:
+                    chunk = list(islice(reader, chunk_size))
+                    if not chunk:
+                        break
+                    n_rows += len(chunk)
+
+                    rows = []
+                    for car in chunk:
+                        try:
+                            rows.append(car_row(car))
+                        except (KeyError, ValueError, TypeError):
+                            continue
+                    inserted += insert_cars(connection, rows)
+
+            connection.commit()
+
+        finally:
+            connection.rollback()
+            if sqlite:
+                if journal_mode != 'wal':
+                    connection.exec_driver_sql(f"PRAGMA journal_mode = {journal_mode}")
+                connection.exec_driver_sql(f"PRAGMA synchronous = {synchronous}")
+                connection.commit()
+
+    seconds = time.perf_counter() - start
+    stats = {'rows': n_rows,
+             'inserted': inserted,
+             'skipped': n_rows - inserted,
+             'seconds': round(seconds, 3),
+             'rows_per_second': round(n_rows / seconds) if seconds > 0 else n_rows}
+    print(f"Imported {inserted} of {n_rows} cars ({stats['rows_per_second']} rows/s), skipped {stats['skipped']}.")
+
+    return stats
+
+
+def populate_database(path, chunk_size=10000) -> dict:
+    """
+    Populates database with entries from csv file in path, see bulk_import.
+    Needs an application context.
+    """
+    stats = bulk_import(path, chunk_size=chunk_size)
+    refresh_facets()
+
+    return stats
 
 
 if __name__=="__main__":
+    from . import create_app
+
     path = 'car_db_backup.csv'
+    app = create_app()
     with app.app_context():
-        db.create_all()
-
-    populate_database(path)
\ No newline at end of file
+        ensure_schema()
+        populate_database(path)
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class PolynomialRegression:
+    """
+    A fitted polynomial regression pipeline (PolynomialFeatures followed by
+    LinearRegression) reduced to its coefficients.
+
+    Every expanded feature is a product of at most degree input features, given by
+    the powers_ of the fitted PolynomialFeatures. predict builds the expanded
+    features with degree column gathers and one multiplication each, and returns
+    their dot product with the coefficients. Nothing is fitted at prediction time.
+    """
+
+    def __init__(self, pipeline):
+        poly, linear = pipeline[0], pipeline[-1]
+        powers = poly.powers_
+        n_features = powers.shape[1]
+        degree = int(powers.sum(axis=1).max())
+
+        # factors[t] lists the input columns multiplied for term t, padded with
+        # n_features, which is a column of ones appended to the input
+        self.factors = np.full((powers.shape[0], degree), n_features, dtype=np.int32)
+        for term, term_powers in enumerate(powers):
+            columns = np.repeat(np.arange(n_features), term_powers)
+            self.factors[term, :len(columns)] = columns
+
+        self.coef = np.asarray(linear.coef_, dtype=np.float64)
+        self.intercept = float(linear.intercept_)
+        self.n_features_in_ = n_features
+
+    def predict(self, X):
+        """
+        Returns the predictions for the rows of X, the same as the pipeline's predict.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        X = np.hstack([X, np.ones((X.shape[0], 1))])
+
+        expanded = X[:, self.factors[:, 0]]
+        for k in range(1, self.factors.shape[1]):
+            expanded *= X[:, self.factors[:, k]]
+
+        return expanded @ self.coef + self.intercept
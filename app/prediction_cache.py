@@ -0,0 +1,214 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import register_collector
+
+
+# Where predictions are cached: 'memory' (per process), 'sqlite:///path/to/file.db'
+# (shared by all workers on the machine) or 'off'
+cache_backend = os.environ.get('CAR_VALUATION_PREDICTION_CACHE', 'memory')
+
+# Seconds a cached prediction is served, and the maximum number of cached predictions
+cache_ttl = float(os.environ.get('CAR_VALUATION_PREDICTION_CACHE_TTL', 3600))
+cache_size = int(os.environ.get('CAR_VALUATION_PREDICTION_CACHE_SIZE', 10000))
+
+# Inputs are rounded before predicting, so that nearby queries share one entry.
+# Mileage is rounded to mileage_step and the traffic date to the first of its month.
+mileage_step = 100
+
+
+def normalize_inputs(manufacturer: str, model: str, mileage: int, hp: int, traffic_date: str,
+                     fuel: str, gearbox: str, owners: int) -> dict:
+    """
+    Returns the prediction inputs in the form that is both predicted on and
+    used as cache key.
+    """
+    if re.fullmatch(r'\d{4}-\d{2}-\d{2}', traffic_date or ''):
+        traffic_date = traffic_date[:7] + '-01'
+
+    return {'manufacturer': manufacturer.strip(),
+            'model': model.strip(),
+            'mileage': int(round(mileage / mileage_step)) * mileage_step,
+            'hp': hp,
+            'traffic_date': traffic_date,
+            'fuel': fuel.strip(),
+            'gearbox': gearbox.strip(),
+            'owners': owners}
+
+
+def cache_key(inputs: dict, version: int, fingerprint: str) -> str:
+    """
+    Returns the cache key of inputs predicted with the model of artifact layout
+    version trained on the rows with fingerprint (see segment_fingerprint).
+
+    The key only needs the fingerprint, so the cache is checked before the
+    model is looked up, and a retrained model never serves old entries.
+    """
+    return json.dumps([version, fingerprint, *inputs.values()], separators=(',', ':'))
+
+
+class MemoryBackend:
+    """
+    Least recently used cache in the memory of this process.
+    """
+
+    def __init__(self, max_entries: int = cache_size, ttl: float = cache_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (segment, expires_at, value)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, key: str, segment: tuple, value: dict):
+        with self.lock:
+            self.entries[key] = (segment, time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, segment: tuple):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[0] == segment]:
+                del self.entries[key]
+
+
+class SQLiteBackend:
+    """
+    Cache in a SQLite file that all worker processes on the machine share.
+
+    Every thread uses its own connection. Expired entries are skipped on reads
+    and deleted, together with the oldest entries beyond max_entries, every
+    prune_every writes.
+    """
+
+    prune_every = 100
+
+    def __init__(self, path: str, max_entries: int = cache_size, ttl: float = cache_ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        self.writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections are opened lazily per thread, and again in forked workers
+        conn, pid = getattr(self.local, 'conn', (None, None))
+        if conn is None or pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                    key TEXT PRIMARY KEY,
+                                    manufacturer TEXT,
+                                    model TEXT,
+                                    expires_at REAL,
+                                    value TEXT)""")
+                conn.execute("CREATE INDEX IF NOT EXISTS ix_predictions_segment ON predictions (manufacturer, model)")
+                conn.execute("CREATE INDEX IF NOT EXISTS ix_predictions_expires_at ON predictions (expires_at)")
+            self.local.conn = (conn, os.getpid())
+        return conn
+
+    def get(self, key: str):
+        row = self._connection().execute("SELECT value FROM predictions WHERE key = ? AND expires_at > ?",
+                                         (key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key: str, segment: tuple, value: dict):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+                         (key, *segment, time.time() + self.ttl, json.dumps(value)))
+
+            self.writes += 1
+            if self.writes % self.prune_every == 0:
+                conn.execute("DELETE FROM predictions WHERE expires_at <= ?", (time.time(),))
+                conn.execute("""DELETE FROM predictions WHERE key IN (
+                                    SELECT key FROM predictions ORDER BY expires_at DESC LIMIT -1 OFFSET ?)""",
+                             (self.max_entries,))
+
+    def invalidate(self, segment: tuple):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM predictions WHERE manufacturer = ? AND model = ?", segment)
+
+
+class PredictionCache:
+    """
+    Cache of prediction results in front of the scoring path, with hit and miss counters.
+
+    backend is None (caching off), a MemoryBackend, a SQLiteBackend or any
+    object with the same get, set and invalidate methods.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        if self.backend is None:
+            return None
+
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, segment: tuple, value: dict):
+        if self.backend is not None:
+            self.backend.set(key, segment, value)
+
+    def invalidate(self, manufacturer: str, model: str):
+        """
+        Drops the cached predictions of a segment, e.g. after its model was retrained.
+        """
+        if self.backend is not None:
+            self.backend.invalidate((manufacturer, model))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+def make_backend(spec: str = cache_backend):
+    """
+    Returns the backend described by spec, see cache_backend.
+    """
+    if spec == 'off':
+        return None
+    if spec == 'memory':
+        return MemoryBackend()
+    if spec.startswith('sqlite:///'):
+        return SQLiteBackend(spec.replace('sqlite:///', '', 1))
+    raise ValueError(f"Unknown prediction cache backend {spec!r}")
+
+
+prediction_cache = PredictionCache(make_backend())
+
+
+def prediction_cache_metrics() -> list:
+    stats = prediction_cache.stats()
+    return [('car_valuation_prediction_cache_hits_total', 'counter', 'Predictions answered from the cache.', [({}, stats['hits'])]),
+            ('car_valuation_prediction_cache_misses_total', 'counter', 'Predictions that had to be computed.', [({}, stats['misses'])])]
+
+
+register_collector(prediction_cache_metrics)
@@ -0,0 +1,153 @@
+import hmac
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+# Directory the sampled stacks are written to. Profiling is off while it is not set.
+profile_dir = os.environ.get('CAR_VALUATION_PROFILE_DIR')
+
+# Fraction of requests that are profiled. Requests whose profile_header equals
+# profile_token are always profiled; without a token the header only works in debug mode.
+sample_rate = float(os.environ.get('CAR_VALUATION_PROFILE_RATE', 0.0))
+profile_header = 'X-Profile'
+profile_token = os.environ.get('CAR_VALUATION_PROFILE_TOKEN', '')
+
+# At most this many profiles are kept in profile_dir, later ones are dropped,
+# and each keeps only its max_stacks most frequent stacks
+max_profiles = int(os.environ.get('CAR_VALUATION_PROFILE_MAX_FILES', 500))
+max_stacks = int(os.environ.get('CAR_VALUATION_PROFILE_MAX_STACKS', 2000))
+
+# Seconds between two samples of the profiled thread's stack
+sample_interval = float(os.environ.get('CAR_VALUATION_PROFILE_INTERVAL', 0.005))
+
+# Numbers the profiles written by this process, so that file names never collide
+_sequence = itertools.count(1)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def folded_stack(frame) -> str:
+    """
+    Returns the stack ending in frame as 'outermost;...;innermost', the line
+    format of flamegraph.pl and speedscope.
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame).replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread from a background thread every interval
+    seconds and counts how often each stack was seen.
+
+    Unlike cProfile this does not slow down every function call of the
+    profiled thread, and the counts are proportional to the time spent in each stack.
+    """
+
+    def __init__(self, thread_id: int = None, interval: float = None):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval if interval is not None else sample_interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[folded_stack(frame)] += 1
+            # Drop the reference, so the profiled thread's frames can be freed
+            frame = None
+
+    def start(self) -> 'StackSampler':
+        self.thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+
+def requested_by_header(headers, debug: bool = False) -> bool:
+    """
+    Returns True if headers ask for a profile: profile_header carries
+    profile_token, or is set at all in debug mode.
+    """
+    value = headers.get(profile_header)
+    if not value:
+        return False
+    if profile_token:
+        return hmac.compare_digest(value.encode(), profile_token.encode())
+    return debug
+
+
+def should_profile(headers=None, rate: float = None, debug: bool = False) -> bool:
+    """
+    Returns True if profiling is on and this request is sampled, either by
+    rate (default sample_rate) or because of its headers (see requested_by_header).
+    """
+    if not profile_dir:
+        return False
+    if headers is not None and requested_by_header(headers, debug):
+        return True
+    rate = sample_rate if rate is None else rate
+    return rate > 0 and random.random() < rate
+
+
+def stored_profiles() -> int:
+    """
+    Returns the number of profiles in profile_dir.
+    """
+    try:
+        return sum(1 for entry in os.scandir(profile_dir) if entry.name.endswith('.folded'))
+    except FileNotFoundError:
+        return 0
+
+
+def write_folded(name: str, stacks: Counter) -> str:
+    """
+    Writes the max_stacks most frequent stacks in the folded format to a new
+    file in profile_dir and returns its path, or None if profile_dir already
+    holds max_profiles profiles.
+    """
+    if stored_profiles() >= max_profiles:
+        print(f"Profile {name} dropped, {profile_dir} already holds {max_profiles} profiles.")
+        return None
+    os.makedirs(profile_dir, exist_ok=True)
+    safe_name = re.sub(r'[^\w.-]+', '_', name)
+    path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_sequence)}-{safe_name}.folded")
+    with open(path, 'w') as file:
+        for stack, count in stacks.most_common(max_stacks):
+            file.write(f"{stack} {count}\n")
+    return path
+
+
+@contextmanager
+def profiled(name: str, rate: float = None):
+    """
+    Samples the stack of the current thread while the block runs, if profiling
+    is on and the block is sampled (see should_profile), and writes it to profile_dir.
+    """
+    if not should_profile(rate=rate):
+        yield
+        return
+
+    sampler = StackSampler().start()
+    try:
+        yield
+    finally:
+        write_folded(name, sampler.stop())
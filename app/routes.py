@@ -1,61 +1,48 @@
-from flask import render_template, request, jsonify, Flask
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-import os
+from flask import Blueprint, render_template, request, jsonify, make_response, Response, stream_with_context
+import json
 
+from . import metrics
+from .config import db
+from .facets import build_id, cached_response, facet_cache
 from .models import Car
-from sklearn.preprocessing import MinMaxScaler, PolynomialFeatures
-from .ml_models import polynomial_model, random_forest_model
-from .utils import load_and_transform_data, transform_new_data, load_from_db, load_from_internal_db
 
-app = Flask(__name__, static_folder='static') 
-app.secret_key = os.environ.get('CAR_VALUATION_FLASK_KEY')
+# Create a Blueprint instance, registered by create_app
+main_bp = Blueprint('main', __name__)
 
-# Here we specify location of local SQL database
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///cars.db"
-# We're not gonna track changes to our database for dev purposes
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config['EXPLAIN_TEMPLATE_LOADING'] = True
+# The prediction modules (.batch, .model_registry, .training) pull in pandas and
+# scikit-learn. They are imported in the prediction views on first use, so that
+# workers boot fast and the page and dropdowns never load them.
 
-# Create instance of DB
-db = SQLAlchemy(app)
 
-
-@app.route('/')
+@main_bp.route('/')
 def index():
 
     """
     initialize drop down menus
     """
 
-    # Query all manufacturers. Returns like a list of one element tuples.
-    manufacturers = db.session.query(Car.manufacturer).distinct().all()
-    # A tuple is returned so use list comprehension to extract
-    default_manufacturers = [manufacturer[0] for manufacturer in manufacturers]
-
-    # Query models from the first manufacturer
-    models = db.session.query(Car.model).filter_by(manufacturer=default_manufacturers[0]).distinct().all()
-    # Extract model names to a list
-    default_models = [model[0] for model in models]
+    # The dropdown data comes from the in-process facet cache
+    with metrics.span('facets'):
+        version, facets = facet_cache.get(db.session)
 
-    # Query the fuels
-    fuels = db.session.query(Car.fuel).filter_by(manufacturer=default_manufacturers[0],
-                                                 model=default_models[0]).distinct().all()
-    default_fuels = [fuel[0] for fuel in fuels]
+    default_manufacturers = facets['manufacturers']
+    # Models from the first manufacturer
+    default_models = facets['models'][default_manufacturers[0]]
+    # Fuels and gearboxes of the first model
+    default_fuels = facets['fuels'][(default_manufacturers[0], default_models[0])]
+    default_gearboxes = facets['gearboxes'][(default_manufacturers[0], default_models[0])]
 
-    # Query the gearboxes
-    gearboxes = db.session.query(Car.gearbox).filter_by(manufacturer=default_manufacturers[0],
-                                                 model=default_models[0]).distinct().all()
-    default_gearboxes = [gearbox[0] for gearbox in gearboxes]
+    with metrics.span('render'):
+        response = make_response(render_template('index.html',
+                           all_manufacturers = default_manufacturers,
+                           all_models = default_models,
+                           all_fuels = default_fuels,
+                           all_gearboxes = default_gearboxes))
 
-    return render_template('index.html',
-                       all_manufacturers = default_manufacturers,
-                       all_models = default_models,
-                       all_fuels = default_fuels,
-                       all_gearboxes = default_gearboxes)
+    return cached_response(response, request, version, build=build_id())
 
 
-@app.route('/_update_car_dropdown')
+@main_bp.route('/_update_car_dropdown')
 def update_car_dropdown():
     
     """
@@ -64,24 +51,16 @@ def update_car_dropdown():
 
     # the value of the first dropdown = maufacturer (selected by the user)
     selected_manufacturer = request.args.get('selected_manufacturer', type=str)
-    print(selected_manufacturer)
 
-    # get values for the second dropdown
-    models = db.session.query(Car.model).filter_by(manufacturer=selected_manufacturer).distinct().all()
-    # Extract model names to a list
-    updated_models = [model[0] for model in models]
-    print(updated_models)
-    # create the values in the dropdown as a html string
-    html_string_selected = ''
-    for entry in updated_models:
-        html_string_selected += '<option value="{}">{}</option>'.format(entry, entry)
+    # get the prerendered values for the second dropdown
+    with metrics.span('facets'):
+        version, facets = facet_cache.get(db.session)
+    html_string_selected = facets['models_html'].get(selected_manufacturer, '')
 
-    print(html_string_selected)
+    return cached_response(jsonify(html_string_selected=html_string_selected), request, version)
 
-    return jsonify(html_string_selected=html_string_selected)
 
-
-@app.route('/_update_fuel_and_gearbox_dropdown', methods=['GET'])
+@main_bp.route('/_update_fuel_and_gearbox_dropdown', methods=['GET'])
 def update_fuel_and_gearbox_dropdown():
     """
     Updates fuel and gearbox dropdowns upon changing model.
@@ -91,87 +70,123 @@ def update_fuel_and_gearbox_dropdown():
     selected_manufacturer = request.args.get('selected_manufacturer', type=str)
     selected_model = request.args.get('selected_model', type=str)
 
-    # get the fuel and gearboxes from db
-     # Query the gearboxes
-    gearboxes = db.session.query(Car.gearbox).filter_by(manufacturer=selected_manufacturer,
-                                                 model=selected_model).distinct().all()
-    gearboxes = [gearbox[0] for gearbox in gearboxes]
-
-    # Query the fuels
-    fuels = db.session.query(Car.fuel).filter_by(manufacturer=selected_manufacturer,
-                                                 model=selected_model).distinct().all()
-    fuels = [fuel[0] for fuel in fuels]
+    # get the prerendered fuel and gearbox dropdowns
+    with metrics.span('facets'):
+        version, facets = facet_cache.get(db.session)
+    key = (selected_manufacturer, selected_model)
 
-
-    # create the values in the dropdowns as a html string
-    html_fuels = ''
-    for fuel in fuels:
-        html_fuels += '<option value="{}">{}</option>'.format(fuel, fuel)
-
-    html_gearboxes = ''
-    for gearbox in gearboxes:
-        html_gearboxes += '<option value="{}">{}</option>'.format(gearbox, gearbox)
-   
     response_data = {
-        'html_fuels': html_fuels,
-        'html_gearboxes': html_gearboxes
+        'html_fuels': facets['fuels_html'].get(key, ''),
+        'html_gearboxes': facets['gearboxes_html'].get(key, '')
     }
 
-    return jsonify(response_data)
+    return cached_response(jsonify(response_data), request, version)
 
 
-@app.route('/_predict_price')
+@main_bp.route('/_predict_price')
 def predict_price():
-
-    # Get all data from user input
-    selected_manufacturer = request.args.get('selected_manufacturer', type=str)
-    selected_model = request.args.get('selected_model', type=str)
-
-    mileage = request.args.get('mileage', type=int)
-    hp = request.args.get('hp', type=int)
-    traffic_date = request.args.get('traffic_date', type=str)
-    selected_fuel = request.args.get('selected_fuel', type=str)
-    selected_gearbox = request.args.get('selected_gearbox', type=str)
-    owners = request.args.get('owners', type=int)
-
-    # Load the training data from DB
-    X, y = load_and_transform_data(load_from_internal_db, '', manufacturer=selected_manufacturer, model=selected_model, db=db, table=Car)
-    n_cars = X.shape[0]
-
-    # Scale the numerical variables with a min-max scaler
-    scaler = MinMaxScaler()
-    X[['mileage', 'hp', 'car_age', 'owners']] = scaler.fit_transform(X[['mileage', 'hp', 'car_age', 'owners']])
+    from .model_registry import artifact_version, predict_with_artifact, segment_fingerprint
+    from .prediction_cache import cache_key, normalize_inputs, prediction_cache
+    from .training import ModelWarming, UnknownSegment, request_artifact
+
+    # Get all data from user input. The inputs are rounded (see normalize_inputs)
+    # so that similar queries are answered from the prediction cache.
+    inputs = normalize_inputs(manufacturer=request.args.get('selected_manufacturer', type=str),
+                              model=request.args.get('selected_model', type=str),
+                              mileage=request.args.get('mileage', type=int),
+                              hp=request.args.get('hp', type=int),
+                              traffic_date=request.args.get('traffic_date', type=str),
+                              fuel=request.args.get('selected_fuel', type=str),
+                              gearbox=request.args.get('selected_gearbox', type=str),
+                              owners=request.args.get('owners', type=int))
+    selected_manufacturer, selected_model = inputs['manufacturer'], inputs['model']
+
+    # The version of the segment's cars comes from memory, so cached answers
+    # are returned without touching the model or the database
+    with metrics.span('segment_fingerprint'):
+        fingerprint = segment_fingerprint(selected_manufacturer, selected_model, db)
+
+    # Without cars there is nothing to train on, so no training is started
+    if fingerprint is None:
+        return jsonify({'status': 'failed', 'message': str(UnknownSegment(selected_manufacturer, selected_model))}), 404
+
+    key = cache_key(inputs, artifact_version, fingerprint)
+    with metrics.span('prediction_cache'):
+        result = prediction_cache.get(key)
+    if result is not None:
+        return jsonify(result)
+
+    # Get the trained model for this manufacturer and model. It is only
+    # trained when the cars in the database have changed. If training takes
+    # too long the client is told to come back later.
+    try:
+        artifact = request_artifact(selected_manufacturer, selected_model, db=db, table=Car, fingerprint=fingerprint)
+    except ModelWarming as warming:
+        response = jsonify({'status': 'warming', 'retry_after': warming.retry_after})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(warming.retry_after)
+        return response
+
+    n_cars = artifact['n_cars']
+    MAPE = artifact['MAPE']
+    model_type = artifact['model_type']
 
     # Transform input data to appropriate format
     new_data = {
-        'mileage': [mileage],
-        'hp': [hp],
-        'traffic_date': [traffic_date],
-        'fuel': [selected_fuel],
-        'gearbox': [selected_gearbox],
-        'owners': [owners],
+        'mileage': [inputs['mileage']],
+        'hp': [inputs['hp']],
+        'traffic_date': [inputs['traffic_date']],
+        'fuel': [inputs['fuel']],
+        'gearbox': [inputs['gearbox']],
+        'owners': [inputs['owners']],
     }
-    df_new_data = transform_new_data(new_data, X, scaler)
-
-    #Apply ML models to test data
-    test_size = 0.15 # this is somewhat arbitrary
-    rfm, MAE_rf, MAPE_rf = random_forest_model(X, y, test_size=test_size)
-    pm, MAE_pm, MAPE_pm = polynomial_model(X, y, test_size=test_size)
-
-    # Use the best performing model based on mean absolute percentage error
-    if MAPE_rf < MAPE_pm:
-        MAPE = MAPE_rf
-        predicted_price = rfm.predict(df_new_data)[0]
-        model_type = 'random forest-modell'
-    else:
-        MAPE = MAPE_pm
-        poly = PolynomialFeatures(2)
-        df_new_data = poly.fit_transform(df_new_data)
-        predicted_price = pm.predict(df_new_data)[0]
-        model_type = 'polynom-modell'
+    predicted_price = float(predict_with_artifact(artifact, new_data)[0])
 
     result = {'predicted_price': round(predicted_price, -3),
               'error': round(predicted_price * MAPE, -2),
               'n_cars': n_cars,
               'model_type': model_type}
+    prediction_cache.set(key, (selected_manufacturer, selected_model), result)
     return jsonify(result)
+
+
+@main_bp.route('/_predict_batch', methods=['POST'])
+def predict_batch_prices():
+    """
+    Predicts the price of many cars at once.
+
+    The body is either JSON (a list of cars, or {"cars": [...]}), newline delimited
+    JSON with one car per line, or CSV with a header row. CSV and newline
+    delimited JSON are read as they arrive, a JSON document is loaded whole. Every car needs manufacturer, model, mileage, hp, traffic_date, fuel, gearbox
+    and owners, and may have an id. Results are streamed back as newline delimited
+    JSON, one line per car, in the order the groups finish.
+    """
+    from .batch import cars_from_json, iter_cars_from_csv, iter_cars_from_ndjson, predict_batch
+
+    if request.mimetype in ('text/csv', 'text/tab-separated-values', 'text/plain'):
+        cars = iter_cars_from_csv(request.stream)
+    elif request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        cars = iter_cars_from_ndjson(request.stream)
+    else:
+        data = request.get_json(silent=True)
+        if data is None:
+            return jsonify({'status': 'failed', 'message': 'Expected a JSON or CSV body.'}), 400
+        try:
+            cars = cars_from_json(data)
+        except ValueError as e:
+            return jsonify({'status': 'failed', 'message': str(e)}), 400
+
+    def generate():
+        for result in predict_batch(cars, db=db, table=Car):
+            yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@main_bp.route('/metrics')
+def prometheus_metrics():
+    """
+    Exposes the request, stage, training and cache metrics of this worker
+    process in the Prometheus text format.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,65 +1,243 @@
+import asyncio
 import os
-import pandas as pd
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from selectolax.parser import HTMLParser
-from .utils import get_car_info
+from .archive import open_archive
+from .extraction import extract_car
+from .profiling import profiled
 
 base_url = os.environ.get('CAR_VALATION_BASE_URL')
 
-def scrape(manufacturer: str, model: str) -> list[dict]:
+# Default number of detail pages fetched at the same time
+default_concurrency = 8
+
+# Default maximum number of requests per second sent to the server
+default_rate = 10.0
+
+# Responses with these status codes are retried with backoff
+retry_statuses = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Async token bucket rate limiter. Allows bursts of up to capacity requests
+    and on average rate requests per second.
     """
-    Scrapes car data using the manufacturer and model strings in the url.
 
-    Returns a list of dictionaries containing information about each car.
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Waits until a token is available and takes it.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def make_session(pool_size: int = default_concurrency) -> requests.Session:
+    """
+    Returns a requests session that keeps up to pool_size connections per host alive.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+async def fetch(session, executor, url: str, limiter: TokenBucket, retries=3, backoff=0.5, timeout=30) -> str:
+    """
+    Fetches url with the pooled session in the executor and returns the html text.
+
+    Connection errors and retry_statuses are retried up to retries times, waiting
+    backoff * 2^attempt seconds in between.
     """
+    loop = asyncio.get_running_loop()
+
+    for attempt in range(retries + 1):
+        await limiter.acquire()
+        try:
+            response = await loop.run_in_executor(executor, lambda: session.get(url, timeout=timeout))
+            if response.status_code in retry_statuses:
+                raise requests.HTTPError(f"{response.status_code} for {url}", response=response)
+            return response.text
+
+        except requests.RequestException as error:
+            if attempt == retries:
+                raise
+            print(f"Retrying {url} due to {error}")
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+
+def listing_id(url: str) -> int:
+    """
+    Returns the listing id at the end of a car url, as stored in get_car_info.
+    """
+    return int(url.split('-')[-1])
+
 
+def listed_cars(car_urls: list) -> list[tuple[str, int]]:
+    """
+    Returns (url, listing id) for every car url that ends in a listing id.
+    Other links, e.g. with a query string, are logged and skipped, as
+    get_car_info could not store them either.
+    """
+    listed = []
+    for url in car_urls:
+        try:
+            listed.append((url, listing_id(url)))
+        except ValueError:
+            print(f"Skipping {url}, it has no listing id")
+    return listed
+
+
+async def fetch_listing_urls(session, executor, limiter, manufacturer: str, model: str, retries=3, backoff=0.5) -> list[str]:
+    """
+    Returns the urls of all listed cars of manufacturer and model from the index pages.
+    """
     # get number of cars from inital request
     start_url = f"{base_url}/{manufacturer}/{model}"
-    response = requests.get(start_url)
-    start_html = HTMLParser(response.text)
+    start_html = HTMLParser(await fetch(session, executor, start_url, limiter, retries, backoff))
     # number of cars at top of page inside span of div
     n_cars = int(start_html.css_first('div.u-textCenter.u-marginTmd').css_first('span').text().replace(" ", ""))
 
     # get full html using number of cars
     url = f"{base_url}/{manufacturer}/{model}?limit={n_cars}"
-    response = requests.get(url)
-    html = HTMLParser(response.text)
-
-    # get url to all cars
-    car_urls = []
-    for i, link in enumerate(html.css('a.go_to_detail')[0:n_cars]):
-        car_urls.append(link.attributes['href'])
-
-    result = []
-    # iterate over cars 
-    for i in range(0, n_cars):
-        # sleep for short time to not overload server
-        time.sleep(0.1)
-        
-        print(f"Fetching car #{i+1} of {n_cars}")
-        
-        url = car_urls[i]
-        response = requests.get(url)
-        html = HTMLParser(response.text)
+    html = HTMLParser(await fetch(session, executor, url, limiter, retries, backoff))
 
-        try:
-            result.append(get_car_info(url, html))
-            
-            # Append manufacturer and model to each dict.
-            result[i]['manufacturer'] = manufacturer
-            result[i]['model'] = model
+    # get url to all cars. There can be fewer links than the count at the top.
+    return [link.attributes['href'] for link in html.css('a.go_to_detail')[0:n_cars]]
 
-        except (AttributeError, ValueError) as error:
-            print(f'Car #[i] could not load url, due to {error}')
-            result.append({})
 
-    return result
+async def fetch_cars(session, executor, limiter, car_urls: list, manufacturer: str, model: str,
+                     concurrency=default_concurrency, retries=3, backoff=0.5, archive=None) -> list[dict]:
+    """
+    Fetches and parses the detail pages in car_urls, up to concurrency at a time.
+    Every fetched page is stored in archive (an HtmlArchive) before it is parsed,
+    so it can be parsed again later without fetching it.
+
+    Returns the car dicts in the order of car_urls. Cars that could not be loaded are empty dicts.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def scrape_car(i, car_url):
+        async with semaphore:
+            print(f"Fetching car #{i+1} of {len(car_urls)}")
+            try:
+                text = await fetch(session, executor, car_url, limiter, retries, backoff)
+                if archive is not None:
+                    # A full disk or unwritable archive must not cost the car itself
+                    try:
+                        await loop.run_in_executor(executor, archive.put, car_url, text, manufacturer, model)
+                    except OSError as error:
+                        print(f'Car #{i+1} could not be archived, due to {error}')
+                info = extract_car(car_url, text)
+
+                # Append manufacturer and model to each dict.
+                info['manufacturer'] = manufacturer
+                info['model'] = model
+                return info
+
+            except (AttributeError, ValueError, requests.RequestException) as error:
+                print(f'Car #{i+1} could not load url, due to {error}')
+                return {}
+
+    return list(await asyncio.gather(*[scrape_car(i, car_url) for i, car_url in enumerate(car_urls)]))
+
+
+async def scrape_async(manufacturer: str, model: str, concurrency=default_concurrency, rate=default_rate,
+                       retries=3, backoff=0.5, known_ids=None) -> tuple[list[dict], list[int]]:
+    """
+    Scrapes car data using the manufacturer and model strings in the url, fetching
+    up to concurrency detail pages at a time and at most rate requests per second.
+
+    Detail pages of listings whose id is in known_ids are not fetched. Fetched
+    detail pages are stored in the raw page archive, see archive.archive_dir.
+
+    Returns the list of scraped car dicts (in listing order, empty dicts for cars
+    that could not be loaded) and the ids of all listed cars. Links without a
+    listing id are skipped (see listed_cars).
+    """
+    limiter = TokenBucket(rate)
+    known_ids = known_ids or set()
+    # Like a failed put, an archive that cannot be opened does not stop the scrape
+    try:
+        archive = open_archive()
+    except OSError as error:
+        print(f"Scraping without the page archive, due to {error}")
+        archive = None
+
+    # With profiling on, a sampled scrape writes the stacks of the parsing thread
+    with profiled(f"scrape-{manufacturer}-{model}"), make_session(concurrency) as session, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        car_urls = await fetch_listing_urls(session, executor, limiter, manufacturer, model, retries, backoff)
+        listed = listed_cars(car_urls)
+        listed_ids = [car_id for url, car_id in listed]
+
+        new_urls = [url for url, car_id in listed if car_id not in known_ids]
+        cars = await fetch_cars(session, executor, limiter, new_urls, manufacturer, model, concurrency, retries, backoff,
+                                archive=archive)
+
+    return cars, listed_ids
+
+
+def scrape(manufacturer: str, model: str, concurrency=default_concurrency, rate=default_rate) -> list[dict]:
+    """
+    Scrapes car data using the manufacturer and model strings in the url.
+
+    Returns a list of dictionaries containing information about each car.
+    See scrape_async for concurrency and rate.
+    """
+    cars, listed_ids = asyncio.run(scrape_async(manufacturer, model, concurrency=concurrency, rate=rate))
+    return cars
+
+
+def scrape_incremental(manufacturer: str, model: str, concurrency=default_concurrency, rate=default_rate) -> dict:
+    """
+    Scrapes only the listings of manufacturer and model that are not in the car
+    table yet, stores them, and marks stored listings that are gone as delisted.
+
+    Needs an application context. Returns counts of listed, fetched, inserted,
+    delisted and relisted cars.
+    """
+    from .models import refresh_facets, save_cars, segment_car_ids, update_listing_status
+
+    # One query for all stored listing ids of the segment
+    known = segment_car_ids(manufacturer, model)
+
+    cars, listed_ids = asyncio.run(scrape_async(manufacturer, model, concurrency=concurrency, rate=rate,
+                                                known_ids=set(known)))
+
+    inserted = save_cars(cars)
+    status = update_listing_status(manufacturer, model, listed_ids, known=known)
+    if inserted or status['delisted'] or status['relisted']:
+        refresh_facets()
+
+    return {'listed': len(listed_ids), 'fetched': len(cars), 'inserted': inserted, **status}
 
 
 if __name__ == "__main__":
     import os
-    from utils import save_to_cloud
+    import sys
+    from .utils import save_to_cloud
 
     url = os.environ.get('RENDER_TEST_DB_EXTERNAL_URL')
 
@@ -93,7 +271,20 @@ if __name__ == "__main__":
     """
     manufacturers = ['Skoda', 'Subaru']
 
-    for manufacturer in manufacturers:
-        for model in cars[manufacturer]:
-            result = scrape(manufacturer, model)
-            save_to_cloud(result, 'cars', url)
+    # python -m app.scraper --incremental updates the local database and only
+    # fetches listings that are not stored yet.
+    if '--incremental' in sys.argv:
+        from . import create_app
+        from .models import ensure_schema
+
+        with create_app().app_context():
+            ensure_schema()
+            for manufacturer in manufacturers:
+                for model in cars[manufacturer]:
+                    print(manufacturer, model, scrape_incremental(manufacturer, model))
+
+    else:
+        for manufacturer in manufacturers:
+            for model in cars[manufacturer]:
+                result = scrape(manufacturer, model)
+                save_to_cloud(result, 'cars', url)
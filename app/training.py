@@ -0,0 +1,235 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError, wait as wait_for
+from concurrent.futures.process import BrokenProcessPool
+
+from .metrics import observe_stage, span, training_runs
+from .model_registry import (cached_artifact, remember_artifact, segment_fingerprint,
+                             train_and_save_artifact)
+from .utils import load_and_transform_data, load_from_internal_db
+
+
+# Maximum number of model fits that run at the same time in this process
+max_training_workers = int(os.environ.get('CAR_VALUATION_TRAINING_WORKERS', 2))
+
+# Seconds a request waits for a model being trained before it gets a "model warming" answer
+training_wait = float(os.environ.get('CAR_VALUATION_TRAINING_WAIT', 2.0))
+
+# Seconds the client is asked to wait before it tries again
+retry_after = int(os.environ.get('CAR_VALUATION_RETRY_AFTER', 5))
+
+# Seconds a failed training is not retried for the same rows, the error is raised again instead
+failure_backoff = float(os.environ.get('CAR_VALUATION_TRAINING_BACKOFF', 60.0))
+
+_executor = None
+# Training jobs in flight, keyed on (manufacturer, model). Concurrent callers share the future.
+_in_flight = {}
+# Failed trainings, (manufacturer, model) -> (fingerprint, retry after monotonic time, exception)
+_failures = {}
+_lock = threading.Lock()
+
+
+class ModelWarming(Exception):
+    """
+    Raised when the model for a segment is still being trained.
+
+    retry_after is the number of seconds after which the client should try again.
+    """
+    def __init__(self, manufacturer: str, model: str, retry_after: int = retry_after):
+        super().__init__(f"Model for {manufacturer} {model} is being trained.")
+        self.retry_after = retry_after
+
+
+class UnknownSegment(Exception):
+    """
+    Raised for a manufacturer and model without any cars, for which no model can be trained.
+    """
+    def __init__(self, manufacturer: str, model: str):
+        super().__init__(f"There are no cars of {manufacturer} {model}.")
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    Returns the process pool used for training, creating it on first use.
+
+    Workers are spawned rather than forked, so they do not inherit the
+    database connections and threads of the web server process.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max_training_workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def _discard_executor(executor: ProcessPoolExecutor):
+    """
+    Drops executor after one of its workers died, e.g. killed for running out
+    of memory. A broken pool refuses all jobs, so the next one gets a new pool.
+    """
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(*args) -> Future:
+    """
+    Submits a job to the training pool, replacing the pool once if it is broken.
+    """
+    executor = _get_executor()
+    try:
+        job = executor.submit(*args)
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        executor = _get_executor()
+        job = executor.submit(*args)
+    job.executor = executor
+    return job
+
+
+def _remember_failure(key: tuple, fingerprint: str, error: Exception):
+    """
+    Keeps the error of a failed training, so that requests for the same rows get
+    it right away for failure_backoff seconds instead of starting the training again.
+    """
+    print(f"Training {key[0]} {key[1]} failed: {error}")
+    with _lock:
+        _failures[key] = (fingerprint, time.monotonic() + failure_backoff, error)
+
+
+def _start_training(manufacturer: str, model: str, fingerprint: str, db, table) -> Future:
+    """
+    Returns the training future for the segment, submitting a new job to the
+    pool if no job for the segment is already running.
+    """
+    key = (manufacturer, model)
+
+    with _lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            return future
+
+        failure = _failures.get(key)
+        if failure is not None and failure[0] == fingerprint and time.monotonic() < failure[1]:
+            future = Future()
+            future.set_exception(failure[2])
+            return future
+
+        # Register a placeholder before the (slow) data loading so that
+        # concurrent callers for the same segment wait on the same job.
+        future = Future()
+        _in_flight[key] = future
+
+    def on_done(job):
+        try:
+            artifact = job.result()
+            remember_artifact(manufacturer, model, artifact)
+            training_runs.inc(outcome='succeeded')
+            # The stages were timed in the training process
+            for stage, seconds in artifact['timings'].items():
+                observe_stage(stage, seconds)
+            with _lock:
+                _failures.pop(key, None)
+            future.set_result(artifact)
+        except BrokenProcessPool as e:
+            # The worker died, not the training: the segment is retried by the next request
+            training_runs.inc(outcome='failed')
+            print(f"Training {manufacturer} {model} lost its worker: {e}")
+            _discard_executor(job.executor)
+            future.set_exception(e)
+        except Exception as e:
+            training_runs.inc(outcome='failed')
+            _remember_failure(key, fingerprint, e)
+            future.set_exception(e)
+        finally:
+            with _lock:
+                _in_flight.pop(key, None)
+
+    try:
+        X, y = load_and_transform_data(load_from_internal_db, '', manufacturer=manufacturer, model=model, db=db, table=table)
+        job = _submit(train_and_save_artifact, manufacturer, model, X, y, fingerprint)
+        job.add_done_callback(on_done)
+    except Exception as e:
+        if not isinstance(e, BrokenProcessPool):
+            _remember_failure(key, fingerprint, e)
+        future.set_exception(e)
+        with _lock:
+            _in_flight.pop(key, None)
+
+    return future
+
+
+def request_artifact(manufacturer: str, model: str, db, table, wait: float = training_wait, fingerprint: str = None) -> dict:
+    """
+    Returns the trained artifact for manufacturer and model.
+
+    If there is no up to date artifact, training is started in the process pool
+    (or joined, if it is already running) and the caller waits at most wait seconds.
+    Raises ModelWarming if the model is not ready by then, and UnknownSegment,
+    without starting a training, if there are no cars of manufacturer and model.
+
+    Jobs are de-duplicated per process. Other gunicorn workers pick up the
+    stored artifact from disk once it has been written. fingerprint is the
+    segment_fingerprint if the caller already has it.
+    """
+    if fingerprint is None:
+        with span('segment_fingerprint'):
+            fingerprint = segment_fingerprint(manufacturer, model, db)
+    if fingerprint is None:
+        raise UnknownSegment(manufacturer, model)
+
+    with span('artifact_cache'):
+        artifact = cached_artifact(manufacturer, model, fingerprint)
+    if artifact is not None:
+        return artifact
+
+    future = _start_training(manufacturer, model, fingerprint, db, table)
+
+    try:
+        with span('training_wait'):
+            return future.result(timeout=wait)
+    except TimeoutError:
+        raise ModelWarming(manufacturer, model)
+
+
+def request_artifacts(segments: list, db, table, wait: float = training_wait) -> dict:
+    """
+    Returns {(manufacturer, model): artifact or exception} for many segments.
+
+    Training is started for every segment without an up to date artifact
+    before waiting, so cold segments train in parallel in the pool, and all of
+    them share one wait of at most wait seconds. Segments that are not ready by
+    then get a ModelWarming exception, and segments that failed their error.
+    """
+    results, futures = {}, {}
+    for manufacturer, model in segments:
+        try:
+            fingerprint = segment_fingerprint(manufacturer, model, db)
+            if fingerprint is None:
+                raise UnknownSegment(manufacturer, model)
+            artifact = cached_artifact(manufacturer, model, fingerprint)
+            if artifact is not None:
+                results[(manufacturer, model)] = artifact
+            else:
+                futures[(manufacturer, model)] = _start_training(manufacturer, model, fingerprint, db, table)
+        except Exception as e:
+            results[(manufacturer, model)] = e
+
+    if futures:
+        with span('training_wait'):
+            wait_for(futures.values(), timeout=wait)
+
+    for (manufacturer, model), future in futures.items():
+        if not future.done():
+            results[(manufacturer, model)] = ModelWarming(manufacturer, model)
+        elif future.exception() is not None:
+            results[(manufacturer, model)] = future.exception()
+        else:
+            results[(manufacturer, model)] = future.result()
+
+    return results
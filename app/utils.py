@@ -1,12 +1,25 @@
+import csv
+import io
 import numpy as np
 import os
 import pandas as pd
-import psycopg2
+import queue
+import re
 import sqlalchemy
-from selectolax.parser import HTMLParser
-from sklearn.preprocessing import MinMaxScaler
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from functools import lru_cache
 from sqlalchemy import create_engine
-from typing import Callable
+from typing import TYPE_CHECKING, Callable
+
+from .metrics import rows_loaded, span
+
+# psycopg2 is only needed by the Postgres helpers and imported there
+if TYPE_CHECKING:
+    from sklearn.preprocessing import MinMaxScaler
 
 
 # Column datatypes
@@ -80,69 +93,147 @@ def get_car_info(url: str, html) -> dict:
     return info
 
 
-def save_to_cloud(data: list, table_name: str, path: str, required_cols = ['id', 'url', 'price', 'mileage', 'hp', 'gearbox', 'traffic_date', 'owners', 'fuel', 'manufacturer', 'model']):
+# Columns and types of the cars table in the cloud database
+cloud_table_cols = {'id': 'INT PRIMARY KEY',
+                    'url': 'TEXT',
+                    'price': 'INT',
+                    'mileage': 'INT',
+                    'hp': 'INT',
+                    'gearbox': 'VARCHAR(255)',
+                    'traffic_date': 'VARCHAR(255)',
+                    'owners': 'INT',
+                    'fuel': 'VARCHAR(255)',
+                    'manufacturer': 'VARCHAR(255)',
+                    'model': 'VARCHAR(255)'}
+
+# Tables this process already created, so CREATE TABLE is only sent once
+_created_tables = set()
+
+
+def _check_table_name(table_name: str):
     """
-    Saves data in df to table with table_name in Render cloud database.
+    Raises ValueError if table_name is not a plain SQL identifier.
+    """
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', table_name):
+        raise ValueError(f"Invalid table name {table_name!r}")
 
-    path is the external url to the Render database.
 
-    required_cols is a list of keys to data that will represent the columns in the table.
+def _create_table_query(table_name: str) -> str:
+    columns = ',\n'.join(f"    {col} {col_type}" for col, col_type in cloud_table_cols.items())
+    return f"CREATE TABLE IF NOT EXISTS {table_name}(\n{columns}\n);"
+
+
+def _create_index_query(table_name: str, concurrently: bool = False) -> str:
+    # The lookups filter on LOWER(...), so a plain index on the columns would not be used
+    return (f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {table_name}_lower_manufacturer_model_idx "
+            f"ON {table_name} (LOWER(manufacturer), LOWER(model));")
+
+
+def create_cloud_indexes(path: str, table_name: str = 'cars'):
     """
-    
-    conn = None
-    cursor = None
+    Creates the index of the dropdown lookups on an existing table in the
+    Postgres database at path. One-off migration for tables created before the
+    index existed. CONCURRENTLY builds it without blocking writes, which needs
+    autocommit and the privileges of the table owner.
+    """
+    import psycopg2
 
+    _check_table_name(table_name)
+    conn = psycopg2.connect(path)
     try:
-        conn = psycopg2.connect(
-        path,
-    )
-        
-        # Cursor does SQL operations
-        cursor = conn.cursor()
-
-        # Create a table in the database, if it does not already exist
-        create_query = f"""CREATE TABLE IF NOT EXISTS {table_name}(
-            id INT PRIMARY KEY,
-            url TEXT,
-            price INT,
-            mileage INT,
-            hp INT,
-            gearbox VARCHAR(255),
-            traffic_date VARCHAR(255),
-            owners INT,
-            fuel VARCHAR(255),
-            manufacturer VARCHAR(255),
-            model VARCHAR(255)
-        );
-        """
-        cursor.execute(create_query)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(_create_index_query(table_name, concurrently=True))
+    finally:
+        conn.close()
 
-        # Filter the data such that only entries with all keys will be inserted to table
-        filtered_data = [d for d in data if all(key in d for key in required_cols)]
 
-        # Insert into table
-        for item in filtered_data:
-            values = [item[col] for col in required_cols]
-            query = f"""
-                    INSERT INTO {table_name} ({', '.join(required_cols)})
-                    VALUES ({', '.join(['%s'] * len(required_cols))})
-                    ON CONFLICT (id) DO NOTHING;
-                    """
-            cursor.execute(query, values)
+def _copy_to_postgres(conn, rows: list, table_name: str, required_cols: list) -> int:
+    """
+    Writes rows to table_name with COPY into a temporary staging table followed
+    by one INSERT ... ON CONFLICT DO NOTHING. Returns the number of inserted rows.
+    """
+    cols = ', '.join(required_cols)
+
+    with conn.cursor() as cursor:
+        if (conn.dsn, table_name) not in _created_tables:
+            cursor.execute(_create_table_query(table_name))
+            cursor.execute(_create_index_query(table_name))
+            _created_tables.add((conn.dsn, table_name))
+
+        cursor.execute(f"CREATE TEMP TABLE {table_name}_staging (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP;")
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table_name}_staging ({cols}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+        # DISTINCT ON drops duplicates within the batch, ON CONFLICT the ones already stored
+        cursor.execute(f"""
+            INSERT INTO {table_name} ({cols})
+            SELECT DISTINCT ON (id) {cols} FROM {table_name}_staging
+            ON CONFLICT (id) DO NOTHING;
+            """)
+        inserted = cursor.rowcount
+
+    conn.commit()
+    return inserted
+
 
-        # Commit changes
-        conn.commit()
+def _insert_to_sqlite(path: str, rows: list, table_name: str, required_cols: list) -> int:
+    """
+    Writes rows to table_name in the SQLite file at path with one multi-row
+    executemany. Returns the number of inserted rows.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            conn.execute(_create_table_query(table_name))
+            conn.execute(_create_index_query(table_name))
+            before = conn.total_changes
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {table_name} ({', '.join(required_cols)}) VALUES ({', '.join(['?'] * len(required_cols))})",
+                rows)
+            return conn.total_changes - before
+    finally:
+        conn.close()
+
+
+def save_to_cloud(data: list, table_name: str, path: str, required_cols = ['id', 'url', 'price', 'mileage', 'hp', 'gearbox', 'traffic_date', 'owners', 'fuel', 'manufacturer', 'model']) -> dict:
+    """
+    Saves data in df to table with table_name in Render cloud database.
 
-        print(f"Uploaded data on {filtered_data[0]['manufacturer']} {filtered_data[0]['model']} to {table_name}.")
+    path is the external url to the Render database. A sqlite:/// url or a path
+    to a .db file writes to a local SQLite database instead, e.g. for testing.
+
+    required_cols is a list of keys to data that will represent the columns in the table.
+
+    The whole batch is written at once. Returns the number of inserted cars and of
+    skipped cars (incomplete or already stored).
+    """
+    _check_table_name(table_name)
+
+    # Filter the data such that only entries with all keys will be inserted to table
+    rows = [[item[col] for col in required_cols] for item in data if all(key in item for key in required_cols)]
+    counts = {'inserted': 0, 'skipped': len(data)}
+
+    if not rows:
+        return counts
+
+    try:
+        if path.startswith('sqlite:///') or path.endswith('.db'):
+            inserted = _insert_to_sqlite(path.replace('sqlite:///', '', 1), rows, table_name, required_cols)
+        else:
+            with get_pg_pool(path).connection() as conn:
+                inserted = _copy_to_postgres(conn, rows, table_name, required_cols)
+
+        counts = {'inserted': inserted, 'skipped': len(data) - inserted}
+        print(f"Uploaded {counts['inserted']} cars to {table_name}, skipped {counts['skipped']}.")
 
     except Exception as e:
         print(e)
 
-    finally:
-        if cursor is not None:
-            cursor.close()
-        if conn is not None:
-            conn.close()
+    return counts
 
 
 def load_from_csv(path: str, col_dtype=col_dtype) -> pd.DataFrame:
@@ -157,47 +248,51 @@ def load_from_db(path: str, col_dtype=col_dtype, manufacturer='', model='') -> p
     """
     Loads from database to Pandas Dataframe using SQLAlchemy.
     """
-    # Note that for SQL alchemy, the path address needs to be postgresql
-    engine = create_engine(path.replace('postgres', 'postgresql', 1))
-    query = f"""
+    engine = get_engine(path)
+    query = sqlalchemy.text("""
     SELECT *
     FROM cars
-    WHERE LOWER(manufacturer) = '{manufacturer.lower()}' AND LOWER(model) = '{model.lower()}';
-    """
-    df = pd.read_sql(query, engine)
+    WHERE LOWER(manufacturer) = :manufacturer AND LOWER(model) = :model;
+    """)
+    df = pd.read_sql(query, engine, params={'manufacturer': manufacturer.lower(), 'model': model.lower()})
     return df
 
-def load_from_internal_db(path, col_dtype=col_dtype, model='', manufacturer='', db=None, table=None) -> pd.DataFrame:
+# Columns the feature pipeline needs from the cars table
+training_cols = ['price', 'mileage', 'hp', 'gearbox', 'traffic_date', 'owners', 'fuel']
+
+
+def load_from_internal_db(path, col_dtype=col_dtype, model='', manufacturer='', db=None, table=None, chunk_size=None) -> pd.DataFrame:
     """
-    Loads from database to Pandas Dataframe using SQLAlchemy.
+    Loads the training columns for manufacturer and model from the internal database to a Pandas Dataframe.
 
+    Only the columns in training_cols are selected with a Core select, so no ORM
+    objects are built. Rows are read in bulk, or in chunks of chunk_size rows
+    if it is given, and turned into one column per field.
     """
-    
-    query_result = db.session.query(table).filter_by(manufacturer=manufacturer, model=model).all()
-    
-    # Convert query result to a list of dictionaries
-    data = [
-        {
-            'id': car.car_id, # need to rename here
-            'url': car.url,
-            'price': car.price,
-            'mileage': car.mileage,
-            'hp': car.hp,
-            'gearbox': car.gearbox,
-            'traffic_date': car.traffic_date,
-            'owners': car.owners,
-            'fuel': car.fuel,
-            'manufacturer': car.manufacturer,
-            'model': car.model
-        }
-        for car in query_result
-    ]
-
-    # Create a DataFrame from the list of dictionaries
-    df = pd.DataFrame(data)
+    query = sqlalchemy.select(*[getattr(table, col) for col in training_cols]).where(
+        table.manufacturer == manufacturer, table.model == model)
 
-    return df
+    if chunk_size is None:
+        rows = db.session.execute(query).fetchall()
+        chunks = [rows]
+    else:
+        result = db.session.execute(query.execution_options(yield_per=chunk_size))
+        chunks = result.partitions()
 
+    # Numerical columns become float arrays, text columns object arrays
+    dtypes = {col: float if col_dtype[col] is float else object for col in training_cols}
+
+    # Transpose the rows to columns chunk by chunk
+    columns = {col: [] for col in training_cols}
+    for rows in chunks:
+        for col, values in zip(training_cols, zip(*rows)):
+            columns[col].append(np.asarray(values, dtype=dtypes[col]))
+
+    df = pd.DataFrame({col: np.concatenate(values) if values else np.empty(0, dtype=dtypes[col])
+                       for col, values in columns.items()})
+    rows_loaded.inc(len(df))
+
+    return df
 
 
 def load_and_transform_data(strategy: Callable, path: str, **kwargs):
@@ -210,10 +305,16 @@ def load_and_transform_data(strategy: Callable, path: str, **kwargs):
     y is the target price data.
     """
 
-    df = strategy(path, **kwargs)
+    with span('load_data'):
+        df = strategy(path, **kwargs)
+
+    with span('transform'):
+        return _transform_data(df)
+
 
-    # Drop id, url, manufacturer, model
-    df = df.drop(columns=['id', 'url', 'manufacturer', 'model'])
+def _transform_data(df: pd.DataFrame):
+    # Drop id, url, manufacturer, model (if the strategy loaded them)
+    df = df.drop(columns=['id', 'url', 'manufacturer', 'model'], errors='ignore')
 
     # Convert traffic_date to age in years
     df['traffic_date'] = pd.to_datetime(df['traffic_date'])
@@ -244,7 +345,7 @@ def load_and_transform_data(strategy: Callable, path: str, **kwargs):
     return X, y
 
 
-def transform_new_data(new_data: dict, X: pd.DataFrame, scaler: MinMaxScaler) -> pd.DataFrame:
+def transform_new_data(new_data: dict, X: pd.DataFrame, scaler: 'MinMaxScaler') -> pd.DataFrame:
     """
     Transforms a new dataset (dict) to an appropriately formatted
     dataframe. 
@@ -284,20 +385,174 @@ def transform_new_data(new_data: dict, X: pd.DataFrame, scaler: MinMaxScaler) ->
 ### Database functions
 db_url = os.environ.get('RENDER_TEST_DB_EXTERNAL_URL')
 
+# Maximum number of open connections per Postgres database and process
+pg_pool_size = int(os.environ.get('CAR_VALUATION_PG_POOL_SIZE', 5))
+
+# Seconds a caller waits for a free pooled connection
+pg_pool_timeout = 10.0
+
+# Connections idle for longer than this many seconds are checked with SELECT 1 before use
+pg_ping_after = 30.0
+
+# One pool per database url, created on first use (so after gunicorn has forked)
+_pg_pools = {}
+_pg_pools_lock = threading.Lock()
+
+
+class PostgresPool:
+    """
+    Bounded pool of psycopg2 connections to one database.
+
+    Connections are opened on demand and kept open when they are returned, up to
+    pool_size per process. Callers wait for a free connection instead of failing
+    when all are in use. Connections that were closed by the server, or that fail
+    a SELECT 1 after being idle, are replaced.
+    """
+
+    def __init__(self, path: str, pool_size: int = pg_pool_size):
+        self.path = path
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    def _connect(self):
+        import psycopg2
+        return psycopg2.connect(self.path)
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        if conn.closed:
+            return False
+
+        if time.monotonic() - last_used < pg_ping_after:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _checkout(self):
+        # Most recently used connections first, so idle ones can time out
+        while True:
+            try:
+                conn, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+
+            if self._is_healthy(conn, last_used):
+                return conn
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        Yields a healthy connection and returns it to the pool afterwards.
+        The transaction is committed if the block succeeds and rolled back otherwise.
+        """
+        if not self.slots.acquire(timeout=pg_pool_timeout):
+            raise TimeoutError("No free database connection in the pool.")
+
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+            conn.commit()
+
+        except Exception:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            raise
+
+        finally:
+            if conn is not None and not conn.closed:
+                self.idle.put((conn, time.monotonic()))
+            self.slots.release()
+
+
+def get_pg_pool(path: str) -> PostgresPool:
+    """
+    Returns the connection pool for the Postgres database at path.
+    """
+    pool = _pg_pools.get(path)
+    if pool is None:
+        with _pg_pools_lock:
+            pool = _pg_pools.get(path)
+            if pool is None:
+                pool = _pg_pools[path] = PostgresPool(path)
+    return pool
+
+
+@lru_cache(maxsize=None)
+def get_engine(path: str):
+    """
+    Returns one SQLAlchemy engine per Postgres database, with a bounded and
+    health checked connection pool.
+    """
+    # Note that for SQL alchemy, the path address needs to be postgresql
+    url = re.sub(r'^postgres(ql)?://', 'postgresql+psycopg2://', path)
+    return create_engine(url,
+                         pool_size=pg_pool_size, max_overflow=0, pool_timeout=pg_pool_timeout, pool_pre_ping=True)
+
+
+# Lookup queries of the dropdown helpers. They are prepared once per connection,
+# so Postgres parses and plans them only once. Parameters are passed lowercased.
+pg_statements = {
+    # Loose index scan: jumps from one manufacturer to the next in the index
+    # instead of reading every row like SELECT DISTINCT would
+    'car_manufacturers': """WITH RECURSIVE manufacturers(name) AS (
+                                SELECT MIN(LOWER(manufacturer)) FROM cars
+                                UNION ALL
+                                SELECT (SELECT MIN(LOWER(manufacturer)) FROM cars WHERE LOWER(manufacturer) > name)
+                                FROM manufacturers
+                                WHERE name IS NOT NULL
+                            )
+                            SELECT name FROM manufacturers WHERE name IS NOT NULL""",
+    'car_models': """SELECT model
+                     FROM cars
+                     WHERE LOWER(manufacturer) = $1
+                     GROUP BY model
+                     HAVING COUNT(*) > 30""",
+    'car_fuels': """SELECT DISTINCT fuel
+                    FROM cars
+                    WHERE LOWER(manufacturer) = $1 AND LOWER(model) = $2""",
+    'car_gearboxes': """SELECT DISTINCT gearbox
+                        FROM cars
+                        WHERE LOWER(manufacturer) = $1 AND LOWER(model) = $2""",
+}
+
+# Names of the statements prepared on each pooled connection. Prepared statements
+# live as long as the connection, so the entry goes away with it.
+_prepared = weakref.WeakKeyDictionary()
+
+def execute_prepared(cursor, name: str, params: tuple = ()):
+    """
+    Executes the statement name of pg_statements with params, preparing it on the
+    cursor's connection first if needed.
+    """
+    prepared = _prepared.setdefault(cursor.connection, set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {pg_statements[name]};")
+        prepared.add(name)
+
+    if params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))});", params)
+    else:
+        cursor.execute(f"EXECUTE {name};")
+
+
 def database_interaction(path):
     def decorator(func):
         def wrapper(*args, **kwargs):
-            connection = None
-            cursor = None
             result = []
 
             try:
-                # Connect to the database
-                connection = psycopg2.connect(path)
-                cursor = connection.cursor()
-
-                # Call the original function
-                result = func(cursor, *args, **kwargs)
+                # Borrow a connection from the pool of the database
+                with get_pg_pool(path).connection() as connection:
+                    with connection.cursor() as cursor:
+                        # Call the original function
+                        result = func(cursor, *args, **kwargs)
 
                 # Add capitalization
                 result = [r.capitalize() for r in result]
@@ -305,96 +560,58 @@ def database_interaction(path):
             except Exception as e:
                 print(e)
 
-            finally: 
-                # Close the cursor and connection
-                if cursor is not None:
-                    cursor.close()
-
-                if connection is not None:
-                    connection.close()
-
-                return result
+            return result
         return wrapper
     return decorator
 
 @database_interaction(db_url)
 def get_manufacturers_in_db(cursor):
     """
-    Returns a list of all unique car manufacturers in table_name. 
-
-    Path is the url to the Postgres database.
+    Returns a list of all unique car manufacturers in the cars table.
     """
-    manufacturers = []
-    
-    select_query = f"""SELECT DISTINCT LOWER(manufacturer)
-                    FROM cars
-                    ORDER BY LOWER(manufacturer);"""
-    cursor.execute(select_query)
+    execute_prepared(cursor, 'car_manufacturers')
 
-    for row in cursor.fetchall():
-        manufacturers.append(*row)
-
-    manufacturers = [m.capitalize() for m in manufacturers]
-
-    return manufacturers
+    return [row[0] for row in cursor.fetchall()]
 
 @database_interaction(db_url)
 def get_models_in_db(cursor, manufacturer):
+    """
+    Returns the models of manufacturer with more than 30 cars.
+    """
+    execute_prepared(cursor, 'car_models', (manufacturer.lower(),))
 
-    models = []
-
-    # Get query
-    # select_query = f"""SELECT DISTINCT model
-    #                 FROM cars
-    #                 WHERE LOWER(manufacturer) = '{manufacturer.lower()}';"""
-    select_query = f"""SELECT model
-                    FROM cars
-                    WHERE lower(manufacturer) = '{manufacturer.lower()}'  
-                    GROUP BY model
-                    HAVING COUNT(*) > 30;"""
-    cursor.execute(select_query)
-
-    for row in cursor.fetchall():
-        models.append(*row)
-
-    return models
+    return [row[0] for row in cursor.fetchall()]
 
 @database_interaction(db_url)
 def get_fuels_in_db(cursor, manufacturer,  model):
+    """
+    Returns the fuels of the cars of manufacturer and model.
+    """
+    execute_prepared(cursor, 'car_fuels', (manufacturer.lower(), model.lower()))
 
-    fuels = []
-
-    # Get query
-    select_query = f"""SELECT DISTINCT fuel
-                    FROM cars
-                    WHERE LOWER(manufacturer) = '{manufacturer.lower()}' AND LOWER(model) = '{model.lower()}';"""
-    cursor.execute(select_query)
-    
-    for row in cursor.fetchall():
-        fuels.append(*row)
-
-    return fuels
+    return [row[0] for row in cursor.fetchall()]
 
 
 @database_interaction(db_url)
 def get_gearboxes_in_db(cursor, manufacturer, model):
+    """
+    Returns the gearboxes of the cars of manufacturer and model.
+    """
+    execute_prepared(cursor, 'car_gearboxes', (manufacturer.lower(), model.lower()))
 
-    gearboxes = []
+    return [row[0] for row in cursor.fetchall()]
 
-    # Get query
-    select_query = f"""SELECT DISTINCT gearbox
-                    FROM cars
-                    WHERE LOWER(manufacturer) = '{manufacturer.lower()}' AND LOWER(model) = '{model.lower()}';"""
-    cursor.execute(select_query)
-    
-    for row in cursor.fetchall():
-        gearboxes.append(*row)
+if __name__=="__main__":
+    import sys
 
-    return gearboxes
+    db_url = os.environ.get('RENDER_TEST_DB_EXTERNAL_URL')
+
+    # python -m app.utils --create-indexes adds the lookup index to an existing cars table
+    if '--create-indexes' in sys.argv:
+        create_cloud_indexes(db_url)
+        sys.exit()
 
-if __name__=="__main__":
     # 2024-04-04 saving all entries from database in backup as Render will close down the db
-    db_url = os.environ.get('RENDER_TEST_DB_EXTERNAL_URL')
     
     # SQLAlchemy requires postgresql instead of postgres
     engine = create_engine(db_url.replace('postgres', 'postgresql', 1))
@@ -0,0 +1,92 @@
+"""
+Compares get_car_info with the extraction engine in app.extraction on a corpus
+of stored detail pages, and times the bulk re-parse in worker processes.
+
+By default the corpus is synthetic pages written to a temporary directory, with
+the facts marked up in each of the layouts of benchmarks.synthetic.fact_layouts,
+and every other page starting with elements whose classes only resemble those
+of the car data (benchmarks.synthetic.near_misses).
+Pass --pages with a directory of saved pages (<listing id>.html) to use real ones.
+Run from the repository root with:
+    python -m benchmarks.bench_extraction [--pages DIR] [--n N] [--processes N]
+"""
+import argparse
+import glob
+import os
+import tempfile
+import time
+from selectolax.parser import HTMLParser
+
+from app.extraction import extract_car, extract_pages
+from app.utils import get_car_info
+from benchmarks.synthetic import detail_page, fact_layouts, synthetic_cars
+
+
+def write_corpus(directory: str, n: int):
+    layouts = list(fact_layouts)
+    for i, (_, car) in enumerate(synthetic_cars(n).iterrows()):
+        with open(os.path.join(directory, f"{i}.html"), 'w', encoding='utf-8') as file:
+            file.write(detail_page(car, layouts[i % len(layouts)], near_miss=i % 2 == 1))
+
+
+def read_corpus(directory: str) -> list:
+    """
+    Returns (url, html text) for every saved page in directory.
+    """
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.html'))):
+        listing_id = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding='utf-8') as file:
+            pages.append((f"https://www.blocket.se/annons/bil-{listing_id}", file.read()))
+    return pages
+
+
+def old_extract(url: str, text: str) -> dict:
+    try:
+        return get_car_info(url, HTMLParser(text))
+    except (AttributeError, ValueError):
+        return None
+
+
+def time_pages(func, pages: list) -> float:
+    start = time.perf_counter()
+    func(pages)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages')
+    parser.add_argument('--n', type=int, default=2000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        directory = args.pages
+        if directory is None:
+            directory = workdir
+            write_corpus(directory, args.n)
+        pages = read_corpus(directory)
+
+    size = sum(len(text) for _, text in pages) / len(pages)
+    print(f"{len(pages)} pages, {size / 1024:.1f} kB on average\n")
+
+    # The engine has to find the same cars as get_car_info
+    expected = [old_extract(url, text) for url, text in pages]
+    found = [info for info, error in extract_pages(pages, processes=1)]
+    mismatches = sum(old != new for old, new in zip(expected, found))
+    unparsed = sum(old is None for old in expected)
+    print(f"Pages with a different result than get_car_info: {mismatches} ({unparsed} not parsed by get_car_info)\n")
+
+    old_seconds = time_pages(lambda pages: [old_extract(url, text) for url, text in pages], pages)
+    new_seconds = time_pages(lambda pages: [extract_car(url, text) for url, text in pages], pages)
+    print(f"{'get_car_info':<30} {old_seconds / len(pages) * 1e3:8.3f} ms/page")
+    print(f"{'extract_car':<30} {new_seconds / len(pages) * 1e3:8.3f} ms/page ({old_seconds / new_seconds:.1f}x)")
+
+    for processes in sorted({1, args.processes}):
+        seconds = time_pages(lambda pages: extract_pages(pages, processes=processes), pages)
+        print(f"{f'extract_pages, {processes} processes':<30} {len(pages) / seconds:8.0f} pages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Compares transform_new_data with the compiled FeatureEncoder for 1 and 10 000 cars.
+
+Run from the repository root with:
+    python -m benchmarks.bench_features
+"""
+import numpy as np
+import timeit
+from sklearn.preprocessing import MinMaxScaler
+
+from app.features import FeatureEncoder, numerical_cols
+from app.utils import load_and_transform_data, transform_new_data
+from benchmarks.synthetic import new_cars, synthetic_cars
+
+
+def main():
+    X, y = load_and_transform_data(lambda path: synthetic_cars(2000), '')
+    scaler = MinMaxScaler()
+    X[numerical_cols] = scaler.fit_transform(X[numerical_cols])
+    encoder = FeatureEncoder(X.columns, scaler)
+
+    for n in [1, 10_000]:
+        new_data = new_cars(n)
+
+        # The encoder has to give the same numbers as the pandas path
+        expected = transform_new_data(new_data, X, scaler).to_numpy(dtype=float)
+        encoded = encoder.encode(new_data)
+        assert np.array_equal(expected, encoded), f"Encoder differs from transform_new_data for {n} rows"
+
+        repeats = 200 if n == 1 else 5
+        t_pandas = min(timeit.repeat(lambda: transform_new_data(new_data, X, scaler), number=repeats, repeat=3)) / repeats
+        t_encoder = min(timeit.repeat(lambda: encoder.encode(new_data), number=repeats, repeat=3)) / repeats
+
+        print(f"{n:>6} rows: transform_new_data {t_pandas * 1e3:8.3f} ms, "
+              f"FeatureEncoder {t_encoder * 1e3:8.3f} ms, speedup {t_pandas / t_encoder:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Compares the dropdown lookups of app.utils on a large synthetic cars table in
+Postgres: the old queries with inlined values and no index, against the prepared
+statements with bound parameters and the LOWER(manufacturer), LOWER(model) index.
+
+The table is created in its own schema, which is dropped afterwards.
+Run from the repository root with:
+    python -m benchmarks.bench_pg_queries --url postgresql://... [--rows N]
+"""
+import argparse
+import os
+import re
+import time
+from urllib.parse import quote
+
+schema = 'bench_queries'
+
+n_manufacturers = 40
+n_models = 25
+
+fill_query = f"""
+INSERT INTO cars (id, url, price, mileage, hp, gearbox, traffic_date, owners, fuel, manufacturer, model)
+SELECT i,
+       'https://www.blocket.se/annons/' || i,
+       50000 + (i * 7919) %% 400000,
+       (i * 104729) %% 30000,
+       100 + i %% 250,
+       (ARRAY['Manuell', 'Automat'])[1 + i %% 2],
+       (2005 + i %% 19) || '-0' || (1 + i %% 9) || '-15',
+       1 + i %% 4,
+       (ARRAY['Bensin', 'Diesel', 'El', 'Miljöbränsle/Hybrid'])[1 + i %% 4],
+       (ARRAY['VOLVO', 'Volvo', 'volvo'])[1 + i %% 3] || (i %% {n_manufacturers}),
+       'V' || ((i / {n_manufacturers}) %% {n_models})
+FROM generate_series(1, %s::bigint) AS i;
+"""
+
+# The queries as they were before, with the values written into the SQL
+old_queries = {
+    'car_manufacturers': "SELECT DISTINCT LOWER(manufacturer) FROM cars ORDER BY LOWER(manufacturer);",
+    'car_models': "SELECT model FROM cars WHERE lower(manufacturer) = 'volvo7' GROUP BY model HAVING COUNT(*) > 30;",
+    'car_fuels': "SELECT DISTINCT fuel FROM cars WHERE LOWER(manufacturer) = 'volvo7' AND LOWER(model) = 'v3';",
+    'car_gearboxes': "SELECT DISTINCT gearbox FROM cars WHERE LOWER(manufacturer) = 'volvo7' AND LOWER(model) = 'v3';",
+}
+
+params = {'car_manufacturers': (),
+          'car_models': ('volvo7',),
+          'car_fuels': ('volvo7', 'v3'),
+          'car_gearboxes': ('volvo7', 'v3')}
+
+
+def plan_summary(cursor, query: str, args: tuple = ()) -> str:
+    """
+    Returns the scan nodes of the plan of query, e.g. 'Seq Scan' or 'Index Scan'.
+    """
+    cursor.execute(f"EXPLAIN {query}", args)
+    nodes = [row[0].strip().lstrip('-> ').split(' on ')[0].split(' using ')[0] for row in cursor.fetchall()]
+    return ', '.join(node for node in nodes if 'Scan' in node)
+
+
+def time_calls(func, runs: int) -> float:
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default=os.environ.get('RENDER_TEST_DB_EXTERNAL_URL'))
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    if not args.url:
+        parser.error("Pass --url or set RENDER_TEST_DB_EXTERNAL_URL")
+
+    # Every connection of the benchmark, including the pooled ones of app.utils, uses the schema
+    separator = '&' if '?' in args.url else '?'
+    url = f"{args.url}{separator}options={quote(f'-csearch_path={schema}')}"
+
+    import psycopg2
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    cursor = conn.cursor()
+
+    # app.utils binds the helpers to the database url on import
+    os.environ['RENDER_TEST_DB_EXTERNAL_URL'] = url
+    from app import utils
+
+    try:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema};")
+        cursor.execute(utils._create_table_query('cars'))
+        start = time.perf_counter()
+        cursor.execute(fill_query, (args.rows,))
+        cursor.execute("ANALYZE cars;")
+        print(f"Created {args.rows} cars in {time.perf_counter() - start:.1f} s\n")
+
+        old_times = {name: time_calls(lambda: cursor.execute(query) or cursor.fetchall(), args.runs)
+                     for name, query in old_queries.items()}
+        old_plans = {name: plan_summary(cursor, query) for name, query in old_queries.items()}
+
+        # The index is created by the one-off migration, the first helper call prepares the statement
+        utils.create_cloud_indexes(url)
+        helpers = {'car_manufacturers': lambda: utils.get_manufacturers_in_db(),
+                   'car_models': lambda: utils.get_models_in_db('Volvo7'),
+                   'car_fuels': lambda: utils.get_fuels_in_db('Volvo7', 'V3'),
+                   'car_gearboxes': lambda: utils.get_gearboxes_in_db('Volvo7', 'V3')}
+        for name, helper in helpers.items():
+            cursor.execute(old_queries[name])
+            expected = [row[0].capitalize() for row in cursor.fetchall()]
+            assert sorted(helper()) == sorted(expected), f"{name} returns different rows than before"
+        cursor.execute("ANALYZE cars;")
+
+        new_times = {name: time_calls(helper, args.runs) for name, helper in helpers.items()}
+        new_plans = {}
+        for name, statement in utils.pg_statements.items():
+            # $1, $2 are the parameters of the prepared statement
+            new_plans[name] = plan_summary(cursor, re.sub(r'\$\d+', '%s', statement), params[name])
+
+        print(f"{'query':<18} {'before':>10} {'after':>10}  plan before -> after")
+        for name in old_queries:
+            print(f"{name:<18} {old_times[name] * 1e3:8.2f}ms {new_times[name] * 1e3:8.2f}ms  "
+                  f"{old_plans[name]} -> {new_plans[name]}")
+
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE;")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Compares predictions of the fitted polynomial pipeline with the closed form
+PolynomialRegression that is stored in the artifacts, for 1 and 1 000 cars.
+
+Run from the repository root with:
+    python -m benchmarks.bench_polynomial
+"""
+import numpy as np
+import timeit
+from sklearn.preprocessing import MinMaxScaler
+
+from app.features import FeatureEncoder, numerical_cols
+from app.ml_models import polynomial_regressor
+from app.polynomial import PolynomialRegression
+from app.utils import load_and_transform_data
+from benchmarks.synthetic import new_cars, synthetic_cars
+
+
+def main():
+    X, y = load_and_transform_data(lambda path: synthetic_cars(2000), '')
+    scaler = MinMaxScaler()
+    X[numerical_cols] = scaler.fit_transform(X[numerical_cols])
+    encoder = FeatureEncoder(X.columns, scaler)
+
+    pipeline = polynomial_regressor().fit(X.to_numpy(dtype=float), y.to_numpy(dtype=float))
+    closed_form = PolynomialRegression(pipeline)
+
+    for n in [1, 1000]:
+        X_new = encoder.encode(new_cars(n))
+
+        # Both have to give the same prices up to floating point rounding
+        assert np.allclose(pipeline.predict(X_new), closed_form.predict(X_new), rtol=1e-9), \
+            f"PolynomialRegression differs from the pipeline for {n} rows"
+
+        repeats = 1000 if n == 1 else 100
+        t_pipeline = min(timeit.repeat(lambda: pipeline.predict(X_new), number=repeats, repeat=3)) / repeats
+        t_closed = min(timeit.repeat(lambda: closed_form.predict(X_new), number=repeats, repeat=3)) / repeats
+
+        print(f"{n:>5} rows: pipeline {t_pipeline * 1e6:8.1f} us, "
+              f"PolynomialRegression {t_closed * 1e6:8.1f} us, speedup {t_pipeline / t_closed:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Runs the random forest tuning mode on a synthetic segment and prints fit time,
+predict latency, pickled size and cross-validated MAPE of every candidate, next
+to the default forest (1000 trees, unlimited depth).
+
+Run from the repository root with:
+    python -m benchmarks.bench_rf_tuning [--cars N]
+"""
+import argparse
+import pickle
+import time
+from sklearn.preprocessing import MinMaxScaler
+
+from app import model_registry
+from app.features import numerical_cols
+from app.ml_models import cross_validated_mape, predict_latency, random_forest_regressor
+from app.utils import load_and_transform_data
+from benchmarks.synthetic import synthetic_cars
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cars', type=int, default=400)
+    args = parser.parse_args()
+
+    X, y = load_and_transform_data(lambda path: synthetic_cars(args.cars), '')
+
+    start = time.perf_counter()
+    artifact = model_registry.train_artifact(X, y, tuning=True)
+    print(f"\nTuning took {time.perf_counter() - start:.1f} s, kept the {artifact['model_type']} "
+          f"(MAPE {artifact['MAPE']:.4f}, {len(pickle.dumps(artifact['model'])) / 1e6:.2f} MB)")
+
+    # The default forest for comparison, on the features scaled like in train_artifact
+    X_array = X.copy()
+    X_array[numerical_cols] = MinMaxScaler().fit_transform(X_array[numerical_cols])
+    X_array, y_array = X_array.to_numpy(dtype=float), y.to_numpy(dtype=float)
+
+    default = random_forest_regressor()
+    MAPE = cross_validated_mape(default, X_array, y_array, n_splits=model_registry.cv_folds, n_jobs=model_registry.cv_jobs)
+    start = time.perf_counter()
+    default.fit(X_array, y_array)
+    fit_time = time.perf_counter() - start
+    print(f"Default forest: MAPE {MAPE:.4f}, fit {fit_time:.2f} s, "
+          f"predict {predict_latency(default, X_array) * 1e3:.2f} ms, {len(pickle.dumps(default)) / 1e6:.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures scraper throughput against a local stub server at different concurrencies,
+and the offline re-parse of the pages the scraper archived.
+
+The stub answers every detail page after a fixed delay, like a remote server would.
+Run from the repository root with:
+    python -m benchmarks.bench_scraper
+"""
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from selectolax.parser import HTMLParser
+
+from app import archive, scraper
+from app.utils import get_car_info
+from benchmarks.synthetic import detail_page, listing_page, synthetic_cars
+
+# Seconds the stub server takes to answer a detail page
+latency = 0.02
+
+n_cars = 200
+
+
+def make_handler(pages: dict):
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            page = pages.get(self.path.split('?')[0])
+            if page is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            time.sleep(latency)
+            body = page.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), None)
+    host = f"http://127.0.0.1:{server.server_address[1]}"
+
+    cars = synthetic_cars(n_cars)
+    car_paths = [f"/bil/volvo-v60-{i}" for i in range(n_cars)]
+    pages = {path: detail_page(car) for path, (_, car) in zip(car_paths, cars.iterrows())}
+    pages['/Volvo/V60'] = listing_page([host + path for path in car_paths])
+    server.RequestHandlerClass = make_handler(pages)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    scraper.base_url = host
+    # Fetched pages go to a throwaway archive, which is re-parsed at the end
+    archive_dir = tempfile.TemporaryDirectory()
+    archive.archive_dir = archive_dir.name
+
+    # The scraper has to return the same dicts as get_car_info
+    expected = []
+    for path in car_paths:
+        info = get_car_info(host + path, HTMLParser(pages[path]))
+        info['manufacturer'], info['model'] = 'Volvo', 'V60'
+        expected.append(info)
+
+    try:
+        for concurrency in [1, 4, 16]:
+            start = time.perf_counter()
+            result = scraper.scrape('Volvo', 'V60', concurrency=concurrency, rate=1000)
+            elapsed = time.perf_counter() - start
+
+            assert result == expected, "Scraped cars differ from get_car_info"
+            print(f"concurrency {concurrency:>2}: {n_cars / elapsed:7.1f} pages/s ({elapsed:.2f} s)")
+
+        start = time.perf_counter()
+        reparsed, errors = archive.reparse_archive(archive.open_archive(), processes=1)
+        elapsed = time.perf_counter() - start
+
+        assert sorted(reparsed, key=lambda car: car['id']) == expected and not errors, "Re-parsed cars differ from the scraped ones"
+        print(f"re-parse archive: {n_cars / elapsed:7.1f} pages/s ({elapsed:.2f} s)")
+    finally:
+        server.shutdown()
+        archive_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Measures how long creating the web app takes in a fresh interpreter and fails
+when it goes over the budget or loads one of the heavy modules.
+
+Run from the repository root with:
+    python -m benchmarks.bench_startup [--budget SECONDS] [--runs N]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Modules that are only needed for predictions, scraping or plotting.
+# Serving the page and the dropdowns must not import them.
+heavy_modules = ['sklearn', 'pandas', 'numpy', 'scipy', 'joblib', 'matplotlib', 'psycopg2', 'selectolax', 'requests']
+
+# Seconds importing and creating the app may take (median of the runs)
+default_budget = 1.0
+
+measure = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+create_app()
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'heavy': [m for m in %r if m in sys.modules]}))
+""" % (heavy_modules,)
+
+
+def measure_import() -> dict:
+    """
+    Creates the app in a new interpreter and returns the time and the heavy modules it loaded.
+    """
+    output = subprocess.run([sys.executable, '-c', measure], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget', type=float, default=default_budget)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = [measure_import() for _ in range(args.runs)]
+    median = statistics.median(result['seconds'] for result in results)
+    heavy = sorted({module for result in results for module in result['heavy']})
+
+    print(f"create_app: median {median * 1e3:.0f} ms over {args.runs} runs (budget {args.budget * 1e3:.0f} ms)")
+
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(heavy)}")
+        failed = True
+    if median > args.budget:
+        print("FAIL: import time is over budget")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
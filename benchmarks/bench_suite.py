@@ -0,0 +1,269 @@
+"""
+End-to-end benchmark suite for the ingestion, dropdown and prediction paths.
+
+For every dataset size a synthetic backup file is generated and imported into a
+fresh SQLite database with populate_database. Then the suite runs
+micro-benchmarks of single functions and a load test of the Flask app through
+its test client, with several client threads.
+
+The results are written as JSON (default benchmarks/results/<commit>.json).
+Pass --compare with an earlier result file to print the change of every metric.
+
+Run from the repository root with:
+    python -m benchmarks.bench_suite [--sizes 1k,100k,1m] [--requests N] [--concurrency N]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from selectolax.parser import HTMLParser
+
+from app import create_app, model_registry, prediction_cache
+from app.extraction import extract_car
+from app.config import db
+from app.facets import facet_cache
+from app.models import ensure_schema, populate_database
+from app.utils import get_car_info, load_and_transform_data
+from benchmarks.synthetic import detail_page, new_cars, segments, synthetic_dataset
+
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# The model of the benchmarked segment is trained on at most this many of its
+# cars, so that the suite measures serving and not training
+train_sample = 2000
+
+# Values in the results that describe the run rather than measure it
+setting_keys = {'rows', 'runs', 'pages', 'segment_rows', 'requests', 'concurrency'}
+
+
+def parse_size(size: str) -> int:
+    """
+    Returns the number of rows for a size like '1k', '100k' or '1m'.
+    """
+    size = size.strip().lower()
+    factor = {'k': 1_000, 'm': 1_000_000}.get(size[-1], 1)
+    return int(float(size.rstrip('km')) * factor)
+
+
+def timed(func, runs: int) -> dict:
+    """
+    Calls func runs times and returns the median and minimum time per call in milliseconds.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return {'runs': runs,
+            'median_ms': round(statistics.median(times) * 1e3, 4),
+            'min_ms': round(min(times) * 1e3, 4)}
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def load_test(app, urls: list, concurrency: int) -> dict:
+    """
+    Requests every url in urls from concurrency threads, each with its own test
+    client, and returns the throughput and latency percentiles.
+    """
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    chunks = [urls[i::concurrency] for i in range(concurrency)]
+
+    def run(chunk):
+        nonlocal errors
+        client = app.test_client()
+        for url in chunk:
+            start = time.perf_counter()
+            status = client.get(url).status_code
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors += status != 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(run, chunks))
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {'requests': len(urls),
+            'concurrency': concurrency,
+            'errors': errors,
+            'throughput_rps': round(len(urls) / seconds, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1e3, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1e3, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1e3, 3)}
+
+
+def predict_url(manufacturer: str, model: str, car: dict) -> str:
+    return '/_predict_price?' + urlencode({'selected_manufacturer': manufacturer,
+                                           'selected_model': model,
+                                           'mileage': car['mileage'],
+                                           'hp': car['hp'],
+                                           'traffic_date': car['traffic_date'],
+                                           'selected_fuel': car['fuel'],
+                                           'selected_gearbox': car['gearbox'],
+                                           'owners': car['owners']})
+
+
+def bench_size(n: int, workdir: str, n_requests: int, concurrency: int) -> dict:
+    """
+    Runs all benchmarks on a dataset of n synthetic cars and returns their results.
+    """
+    result = {'rows': n}
+
+    cars = synthetic_dataset(n)
+    backup = os.path.join(workdir, f"cars-{n}.tsv")
+    cars.to_csv(backup, sep='\t', index=False)
+
+    # Every size gets its own database, models and caches
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, f'cars-{n}.db')}"})
+    model_registry.model_dir = os.path.join(workdir, f"models-{n}")
+    model_registry.model_cache = model_registry.ArtifactCache()
+    prediction_cache.prediction_cache = prediction_cache.PredictionCache(prediction_cache.make_backend('memory'))
+    facet_cache.state = None
+    model_registry.segment_versions = model_registry.SegmentVersionCache()
+
+    manufacturer, model = segments[0]
+    segment = cars[(cars['manufacturer'] == manufacturer) & (cars['model'] == model)]
+
+    with app.app_context():
+        ensure_schema()
+        start = time.perf_counter()
+        stats = populate_database(backup)
+        seconds = time.perf_counter() - start
+        result['populate_database'] = {'seconds': round(seconds, 3),
+                                       'rows_per_second': round(n / seconds)}
+        print(f"populate_database: {seconds:.2f} s ({stats['inserted']} cars)")
+
+        # Train the benchmarked segment up front, on a sample, under the real fingerprint
+        X, y = load_and_transform_data(lambda path: segment.head(train_sample), '')
+        artifact = model_registry.train_artifact(X, y)
+        artifact['fingerprint'] = model_registry.segment_fingerprint(manufacturer, model, db)
+        model_registry.save_artifact(manufacturer, model, artifact)
+        model_registry.remember_artifact(manufacturer, model, artifact)
+
+    micro = result['micro'] = {}
+    micro['load_and_transform_data'] = dict(timed(lambda: load_and_transform_data(lambda path: segment, ''), 5),
+                                            segment_rows=len(segment))
+
+    pages = [detail_page(car) for _, car in cars.head(100).iterrows()]
+    micro['get_car_info'] = timed(lambda: [get_car_info('https://example.com/bil-1', HTMLParser(page)) for page in pages], 5)
+    micro['get_car_info']['pages'] = len(pages)
+    micro['extract_car'] = dict(timed(lambda: [extract_car('https://example.com/bil-1', page) for page in pages], 5),
+                                pages=len(pages))
+
+    one_car = new_cars(1)
+    micro['encode_one_car'] = timed(lambda: artifact['encoder'].encode(one_car), 1000)
+    micro['predict_with_artifact'] = timed(lambda: model_registry.predict_with_artifact(artifact, one_car), 200)
+
+    rng = random.Random(0)
+    facet_segments = sorted(set(zip(cars['manufacturer'], cars['model'])))
+    probe = new_cars(n_requests, seed=2)
+    probe = [{key: values[i] for key, values in probe.items()} for i in range(n_requests)]
+
+    scenarios = {
+        'index': ['/'] * n_requests,
+        'update_car_dropdown': ['/_update_car_dropdown?' + urlencode({'selected_manufacturer': rng.choice(facet_segments)[0]})
+                                for _ in range(n_requests)],
+        'update_fuel_and_gearbox_dropdown': ['/_update_fuel_and_gearbox_dropdown?' + urlencode(dict(zip(['selected_manufacturer', 'selected_model'], rng.choice(facet_segments))))
+                                             for _ in range(n_requests)],
+        # Different cars every time, so most requests miss the prediction cache
+        'predict_price': [predict_url(manufacturer, model, car) for car in probe],
+        # The same car every time, answered from the prediction cache
+        'predict_price_cached': [predict_url(manufacturer, model, probe[0])] * n_requests,
+    }
+
+    load = result['load'] = {}
+    for name, urls in scenarios.items():
+        load[name] = load_test(app, urls, concurrency)
+        print(f"{name:<34} {load[name]['throughput_rps']:8.1f} req/s  p50 {load[name]['p50_ms']:7.2f} ms  "
+              f"p99 {load[name]['p99_ms']:7.2f} ms  errors {load[name]['errors']}")
+
+    return result
+
+
+def flatten(results: dict, prefix='') -> dict:
+    """
+    Returns the numeric leaves of results keyed on their dotted path.
+    """
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(old: dict, new: dict):
+    """
+    Prints every metric present in both result files with its relative change.
+    """
+    old_flat, new_flat = flatten(old['sizes']), flatten(new['sizes'])
+    print(f"\nCompared with {old.get('commit')}:")
+    for key in sorted(old_flat.keys() & new_flat.keys()):
+        # Settings of the run, not measurements
+        if key.rsplit('.', 1)[-1] in setting_keys:
+            continue
+        if old_flat[key]:
+            change = (new_flat[key] - old_flat[key]) / old_flat[key] * 100
+            print(f"{key:<70} {old_flat[key]:>12} -> {new_flat[key]:>12} ({change:+6.1f}%)")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1k,100k')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--out')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    report = {'commit': commit,
+              'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'cpus': os.cpu_count(),
+              'sizes': {}}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes.split(','):
+            print(f"\n== {size} cars ==")
+            report['sizes'][size] = bench_size(parse_size(size), workdir, args.requests, args.concurrency)
+
+    out = args.out or os.path.join(results_dir, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {out}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
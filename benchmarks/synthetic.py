@@ -0,0 +1,129 @@
+"""
+Synthetic cars and listing pages for the benchmarks.
+"""
+import numpy as np
+import pandas as pd
+
+
+def synthetic_cars(n: int, seed=0, manufacturer='Volvo', model='V60') -> pd.DataFrame:
+    """
+    Returns n random cars with the columns of the cars table.
+
+    Prices depend on age, mileage, horsepower, fuel and gearbox plus noise,
+    so that models trained on them have something to learn.
+    """
+    rng = np.random.default_rng(seed)
+    years = rng.integers(2005, 2024, n)
+    months = rng.integers(1, 13, n)
+    days = rng.integers(1, 29, n)
+    mileage = rng.integers(0, 40_000, n)
+    hp = rng.choice([110, 150, 190, 250, 320], n)
+    gearbox = rng.choice(['automat', 'manuell'], n)
+    fuel = rng.choice(['bensin', 'diesel', 'el', 'miljöbränsle/hybrid'], n)
+
+    age = 2024 - years - months / 12
+    price = ((150_000 + 1_500 * hp) * 0.88 ** age * (1 - mileage / 60_000)
+             * np.where(gearbox == 'automat', 1.05, 1.0) * np.where(fuel == 'el', 1.1, 1.0)
+             * rng.lognormal(0, 0.1, n))
+
+    return pd.DataFrame({'id': np.arange(n),
+                         'url': [f"https://example.com/{manufacturer}-{model}-{i}" for i in range(n)],
+                         'price': np.maximum(price, 20_000).round(-3).astype(int),
+                         'mileage': mileage,
+                         'hp': hp,
+                         'gearbox': gearbox,
+                         'traffic_date': [f"{y}-{m:02d}-{d:02d}" for y, m, d in zip(years, months, days)],
+                         'owners': rng.integers(1, 6, n),
+                         'fuel': fuel,
+                         'manufacturer': manufacturer,
+                         'model': model})
+
+
+# Manufacturers and models of synthetic_dataset. Earlier segments get more cars,
+# like popular models do on the real site.
+segments = [(manufacturer, model)
+            for manufacturer, models in [('Volvo', ['V60', 'V70', 'XC60', 'XC90', 'V90']),
+                                         ('Volkswagen', ['Golf', 'Passat', 'Tiguan', 'Polo']),
+                                         ('Audi', ['A4', 'A6', 'Q5']),
+                                         ('BMW', ['320', '520', 'X3']),
+                                         ('Toyota', ['Corolla', 'RAV4', 'Yaris']),
+                                         ('Kia', ['Ceed', 'Niro']),
+                                         ('Tesla', ['Model 3', 'Model Y'])]
+            for model in models]
+
+
+def synthetic_dataset(n: int, seed=0) -> pd.DataFrame:
+    """
+    Returns n random cars spread over the manufacturers and models in segments,
+    with unique ids and urls.
+    """
+    rng = np.random.default_rng(seed)
+    cars = synthetic_cars(n, seed=seed)
+
+    # Zipf-like popularity of the segments
+    weights = 1 / np.arange(1, len(segments) + 1)
+    picks = rng.choice(len(segments), n, p=weights / weights.sum())
+    cars['manufacturer'] = [segments[i][0] for i in picks]
+    cars['model'] = [segments[i][1] for i in picks]
+    cars['url'] = [f"https://example.com/{manufacturer}-{model}-{i}".replace(' ', '-')
+                   for i, manufacturer, model in zip(cars['id'], cars['manufacturer'], cars['model'])]
+    return cars
+
+
+def new_cars(n: int, seed=1) -> dict:
+    """
+    Returns n random cars in the dict of lists format used for predictions.
+    """
+    df = synthetic_cars(n, seed=seed)
+    return {col: df[col].tolist() for col in ['mileage', 'hp', 'traffic_date', 'fuel', 'gearbox', 'owners']}
+
+
+def listing_page(car_urls: list) -> str:
+    """
+    Returns the html of a listing page with links to car_urls.
+    """
+    links = ''.join(f'<div class="Card"><a class="go_to_detail" href="{url}">Bil</a></div>' for url in car_urls)
+    return (f'<html><body><div class="u-textCenter u-marginTmd"><span>{len(car_urls)}</span> bilar</div>'
+            f'{links}</body></html>')
+
+
+# Markup of one fact of a detail page. get_car_info takes the first h5 and the
+# first p of every li, so all of these give the same car.
+fact_layouts = {'flat': '<li class="List-item"><h5>{title}</h5><p>{value}</p></li>',
+                'label_in_div': '<li class="List-item"><div><h5>{title}</h5></div><p>{value}</p></li>',
+                'value_in_div': '<li class="List-item"><h5>{title}</h5><div><p>{value}</p></div></li>',
+                'value_first': '<li class="List-item"><p>{value}</p><h5>{title}</h5></li>'}
+
+
+# Elements before the real price cell and list of facts whose classes only
+# resemble theirs, e.g. u-textRight-md for u-textRight. get_car_info skips them.
+near_misses = ('<div class="Grid-cell u-size1of2 u-textRight-md"><span>999 kr</span></div>'
+               '<ul class="List--horizontal List--bordered u-sm-size1of1 List--allbordered u-marginBlg">'
+               '<li><h5>Mil</h5><p>1</p></li></ul>')
+
+
+def detail_page(car: dict, layout: str = 'flat', near_miss: bool = False) -> str:
+    """
+    Returns the html of the detail page of car (a row of synthetic_cars), in the
+    layout get_car_info parses, padded with unrelated markup like a real page.
+    layout is the markup of the facts, a key of fact_layouts, and near_miss puts
+    near_misses in front of the car data.
+    """
+    price = f"{int(car['price']):,}".replace(',', ' ')
+    mileage = f"{int(car['mileage']):,}".replace(',', ' ')
+    fields = [('Mil', mileage),
+              ('Hästkrafter', str(int(car['hp']))),
+              ('Växellåda', car['gearbox'].capitalize()),
+              ('1:a regdatum', car['traffic_date']),
+              ('Antal ägare', str(int(car['owners']))),
+              ('Drivmedel', car['fuel'].capitalize()),
+              ('Färg', 'Svart'),
+              ('Biltyp', 'Kombi')]
+    items = ''.join(fact_layouts[layout].format(title=title, value=value) for title, value in fields)
+    filler = ''.join(f'<div class="Related"><a href="/bil-{i}">Annan bil {i}</a><p>Text om bilen.</p></div>'
+                     for i in range(200))
+    return ('<html><head><title>Bil</title></head><body>'
+            f'{near_misses if near_miss else ""}<div class="Grid"><div class="Grid-cell u-size1of2"><h1>Bil</h1></div>'
+            f'<div class="Grid-cell u-size1of2 u-textRight"><span>{price} kr</span></div></div>'
+            '<ul class="List List--horizontal List--bordered u-sm-size1of1 List--allbordered u-marginBlg">'
+            f'{items}</ul>{filler}</body></html>')
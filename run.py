@@ -1,8 +1,7 @@
-from app.routes import app, db
+from app import create_app
 
+app = create_app()
 
-if __name__ == "__main__":
-    with app.app_context():
-        db.create_all()
 
+if __name__ == "__main__":
     app.run(debug=False)
\ No newline at end of file
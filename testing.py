@@ -6,9 +6,12 @@
 # from .utils import load_and_transform_data, load_from_db, transform_new_data
 
 
-from app.routes import app, db
+from app import create_app
+from app.config import db
 from app.models import Car
 
+app = create_app()
+
 def test_database_population():
     # Query the Car table to retrieve all car records
     with app.app_context():